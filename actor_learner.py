@@ -0,0 +1,377 @@
+import copy
+import queue
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import utils
+from logger import EnvStepLogger
+
+
+def _state_tensors(module):
+    return list(module.parameters()) + list(module.buffers())
+
+
+class WeightSnapshot(object):
+    """Actor weights in shared memory, versioned by a publish counter.
+
+    The learner publishes after its updates, actor processes pull a copy when
+    they fall behind. Both sides copy under the counter's lock, so a pull
+    never sees a half written snapshot.
+    """
+
+    def __init__(self, module, ctx):
+        self.tensors = [
+            t.detach().cpu().clone().share_memory_() for t in _state_tensors(module)
+        ]
+        self.version = ctx.Value("l", 0)
+
+    @torch.no_grad()
+    def publish(self, module):
+        with self.version.get_lock():
+            for dst, src in zip(self.tensors, _state_tensors(module)):
+                dst.copy_(src)
+            self.version.value += 1
+
+    @torch.no_grad()
+    def pull(self, module):
+        """Copies the snapshot into module, returns its version."""
+        with self.version.get_lock():
+            for dst, src in zip(_state_tensors(module), self.tensors):
+                dst.copy_(src)
+            return self.version.value
+
+
+class TransitionQueue(object):
+    """Pool of shared-memory chunks that carry transitions to the learner.
+
+    Actors fill a free chunk and pass its index through `filled`, the learner
+    returns it through `free` once it is copied into the replay buffer. When
+    the pool is empty the actors block, which bounds how far collection can
+    run ahead of ingestion.
+    """
+
+    def __init__(self, ctx, obs_shape, obs_dtype, action_shape, num_chunks, chunk_len):
+        def alloc(shape, dtype):
+            shape = (num_chunks, chunk_len, *shape)
+            return torch.zeros(shape, dtype=dtype).share_memory_()
+
+        obs_dtype = torch.from_numpy(np.empty(0, dtype=obs_dtype)).dtype
+        self.chunk_len = chunk_len
+        self.obses = alloc(obs_shape, obs_dtype)
+        self.next_obses = alloc(obs_shape, obs_dtype)
+        self.actions = alloc(action_shape, torch.float32)
+        self.rewards = alloc((1,), torch.float32)
+        self.dones = alloc((1,), torch.float32)
+        # weight snapshot version the transition was collected with
+        self.versions = alloc((), torch.int64)
+        self.free = ctx.Queue()
+        self.filled = ctx.Queue()
+        for chunk in range(num_chunks):
+            self.free.put(chunk)
+
+    def arrays(self):
+        """numpy views of obs, action, reward, next_obs, done and version."""
+        return tuple(
+            t.numpy()
+            for t in (
+                self.obses,
+                self.actions,
+                self.rewards,
+                self.next_obses,
+                self.dones,
+                self.versions,
+            )
+        )
+
+
+class ChunkWriter(object):
+    """Actor side of a TransitionQueue, fills one chunk at a time."""
+
+    def __init__(self, transitions, stop):
+        self.transitions = transitions
+        self.stop = stop
+        self.arrays = transitions.arrays()
+        self.chunk = None
+        self.size = 0
+
+    def _acquire(self):
+        while not self.stop.is_set():
+            try:
+                return self.transitions.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def add(self, obs, action, reward, next_obs, done, version):
+        """Returns False once the learner asked the actors to stop."""
+        if self.chunk is None:
+            self.chunk = self._acquire()
+            if self.chunk is None:
+                return False
+        values = (obs, action, reward, next_obs, done, version)
+        for array, value in zip(self.arrays, values):
+            array[self.chunk, self.size] = value
+        self.size += 1
+        if self.size == self.transitions.chunk_len:
+            self.flush()
+        return True
+
+    def flush(self):
+        if self.size > 0:
+            self.transitions.filled.put((self.chunk, self.size))
+            self.chunk = None
+            self.size = 0
+
+
+def policy_action(actor, obs, image_size):
+    """RadSacAgent.sample_action for a cpu copy of the actor."""
+    if obs.shape[-1] != image_size:
+        obs = utils.center_crop_image(obs, image_size)
+    with torch.no_grad():
+        obs = torch.as_tensor(obs)
+        if obs.is_floating_point():
+            obs = obs.float()
+        _, pi, _, _ = actor(obs.unsqueeze(0), compute_log_pi=False)
+    return pi.numpy().flatten()
+
+
+def run_actor(
+    rank, args, env_fn, actor, transitions, snapshot, env_steps, episodes, stop
+):
+    """Collects transitions with the latest snapshot of the learner's actor.
+
+    The first args.init_steps env steps, counted over all actors, take random
+    actions. A new snapshot is pulled once the local weights are
+    args.async_max_policy_lag versions behind.
+    """
+    torch.set_num_threads(1)
+    seed = args.seed + 1 + rank
+    utils.set_seed_everywhere(seed)
+    # the learner may stop consuming before everything we put is read
+    transitions.filled.cancel_join_thread()
+    episodes.cancel_join_thread()
+
+    env = env_fn(seed)
+    writer = ChunkWriter(transitions, stop)
+    version = snapshot.pull(actor)
+    actor.train(False)
+
+    obs, done = env.reset(), False
+    episode_reward, episode_step = 0, 0
+    while not stop.is_set():
+        if snapshot.version.value - version >= args.async_max_policy_lag:
+            version = snapshot.pull(actor)
+
+        if env_steps.value < args.init_steps:
+            action = env.action_space.sample()
+        else:
+            action = policy_action(actor, obs, args.image_size)
+        next_obs, reward, done, _ = env.step(action)
+        with env_steps.get_lock():
+            env_steps.value += 1
+
+        # allow infinit bootstrap
+        done_bool = 0 if episode_step + 1 == env._max_episode_steps else float(done)
+        if not writer.add(obs, action, reward, next_obs, done_bool, version):
+            break
+        episode_reward += reward
+        episode_step += 1
+        obs = next_obs
+
+        if done:
+            # hand over partial chunks so episodes reach the learner whole
+            writer.flush()
+            episodes.put(episode_reward)
+            obs, done = env.reset(), False
+            episode_reward, episode_step = 0, 0
+
+
+def ingest(transitions, arrays, replay_buffer, block=False, limit=None):
+    """Copies filled chunks into replay_buffer, until limit transitions if given.
+
+    returns the number of transitions and the sum of their snapshot versions.
+    """
+    count, version_sum = 0, 0
+    while limit is None or count < limit:
+        try:
+            chunk, size = transitions.filled.get(block=block, timeout=0.1)
+        except queue.Empty:
+            break
+        obses, actions, rewards, next_obses, dones, versions = [
+            array[chunk, :size] for array in arrays
+        ]
+        replay_buffer.add_batch(obses, actions, rewards, next_obses, dones)
+        count += size
+        version_sum += int(versions.sum())
+        transitions.free.put(chunk)
+        block = False
+    return count, version_sum
+
+
+def check_actors(actors):
+    """Raises if an actor process exited, they only stop once asked to."""
+    for rank, actor in enumerate(actors):
+        if actor.exitcode is not None:
+            raise RuntimeError(
+                "actor process %d exited with code %s" % (rank, actor.exitcode)
+            )
+
+
+def train_async(
+    args,
+    env_fn,
+    agent,
+    replay_buffer,
+    sampler,
+    L,
+    evaluate,
+    poll_evals=None,
+    timer=utils.NULL_TIMER,
+    prof=None,
+):
+    """Trains with args.async_actors actor processes feeding a learner.
+
+    The learner ingests transitions, runs agent.update and publishes actor
+    weights every args.async_publish_interval updates. All metrics are logged
+    at the number of ingested env steps as in the synchronous loop, while
+    agent.update counts the learner's own updates for its update and logging
+    frequencies. evaluate(step, episode) runs at every eval_freq env steps,
+    poll_evals once per learner iteration.
+
+    The staleness bounds are ratios of updates per ingested env step after
+    init_steps: above args.async_max_update_ratio the learner waits for data,
+    below args.async_min_update_ratio it stops ingesting until the actors
+    block on the chunk pool. A ratio <= 0 disables the bound.
+
+    prof steps once per update. Returns the number of ingested env steps.
+    """
+    assert (
+        args.async_min_update_ratio <= 0
+        or args.async_max_update_ratio <= 0
+        or args.async_min_update_ratio <= args.async_max_update_ratio
+    ), "async_min_update_ratio is above async_max_update_ratio"
+    ctx = mp.get_context("spawn")
+    snapshot = WeightSnapshot(agent.actor, ctx)
+    snapshot.publish(agent.actor)
+    transitions = TransitionQueue(
+        ctx,
+        replay_buffer.obs_shape,
+        replay_buffer.obs_dtype,
+        replay_buffer.actions.shape[1:],
+        args.async_queue_chunks,
+        args.async_chunk_len,
+    )
+    arrays = transitions.arrays()
+    env_steps = ctx.Value("l", 0)
+    episodes = ctx.Queue()
+    stop = ctx.Event()
+
+    policy = copy.deepcopy(agent.actor).cpu()
+    actors = [
+        ctx.Process(
+            target=run_actor,
+            args=(
+                rank,
+                args,
+                env_fn,
+                policy,
+                transitions,
+                snapshot,
+                env_steps,
+                episodes,
+                stop,
+            ),
+            daemon=True,
+        )
+        for rank in range(args.async_actors)
+    ]
+    for actor in actors:
+        actor.start()
+
+    update_logger = EnvStepLogger(L)
+    step, update_step, episode = 0, 0, 0
+    next_eval, next_log = 0, args.log_interval
+    version_sum, version_count = 0, 0
+    last_time, last_env_steps, last_update_step = time.time(), 0, 0
+    try:
+        while step < args.num_train_steps:
+            check_actors(actors)
+            if step >= next_eval:
+                evaluate(step, episode)
+                while next_eval <= step:
+                    next_eval += args.eval_freq
+            if poll_evals is not None:
+                poll_evals()
+
+            max_updates, min_updates = float("inf"), 0
+            if args.async_max_update_ratio > 0:
+                max_updates = args.async_max_update_ratio * (step - args.init_steps)
+            if args.async_min_update_ratio > 0:
+                min_updates = args.async_min_update_ratio * (step - args.init_steps)
+            # wait for data while warming up or when the update ratio is reached
+            learn = step >= args.init_steps and update_step < max_updates
+            if update_step >= min_updates or not learn:
+                # stop at the next step the loop acts on, a chunk can still
+                # cross it by less than async_chunk_len
+                limit = min(args.num_train_steps, next_eval)
+                if step < args.init_steps:
+                    limit = min(limit, args.init_steps)
+                count, versions = ingest(
+                    transitions, arrays, replay_buffer, not learn, limit - step
+                )
+                step += count
+                version_sum += versions
+                version_count += count
+
+            if learn:
+                update_logger.step = step
+                agent.update(sampler, update_logger, update_step)
+                update_step += 1
+                if prof is not None:
+                    prof.step()
+                if update_step % args.async_publish_interval == 0:
+                    snapshot.publish(agent.actor)
+
+            while True:
+                try:
+                    episode_reward = episodes.get_nowait()
+                except queue.Empty:
+                    break
+                episode += 1
+                L.log("train/episode_reward", episode_reward, step)
+
+            if step >= next_log:
+                now = time.time()
+                duration = now - last_time
+                num_env_steps = env_steps.value
+                L.log("train/episode", episode, step)
+                L.log("train/duration", duration, step)
+                L.log(
+                    "train/actor_fps", (num_env_steps - last_env_steps) / duration, step
+                )
+                L.log(
+                    "train/learner_ups",
+                    (update_step - last_update_step) / duration,
+                    step,
+                )
+                if version_count > 0:
+                    lag = snapshot.version.value - version_sum / version_count
+                    L.log("train/policy_lag", lag, step)
+                timer.log(L, step)
+                L.dump(step)
+                last_time, last_env_steps = now, num_env_steps
+                last_update_step = update_step
+                version_sum, version_count = 0, 0
+                next_log += args.log_interval
+
+        evaluate(step, episode)
+        return step
+    finally:
+        stop.set()
+        for actor in actors:
+            actor.join(timeout=5)
+            if actor.is_alive():
+                actor.terminate()
@@ -0,0 +1,246 @@
+import argparse
+import json
+import platform
+import time
+
+import numpy as np
+import torch
+
+import utils
+from curl_sac import EnsembleQFunction, QFunction, RadSacAgent
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark RadSacAgent updates on synthetic replay data"
+    )
+    parser.add_argument("--num_q_heads", nargs="+", type=int, default=[2])
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--hidden_dim", default=1024, type=int)
+    parser.add_argument("--image_size", default=84, type=int)
+    parser.add_argument("--pre_image_size", default=100, type=int)
+    parser.add_argument("--frame_stack", default=3, type=int)
+    parser.add_argument("--action_dim", default=6, type=int)
+    parser.add_argument("--data_augs", default="crop", type=str)
+    # also time RadSacAgent(compile_update=True), the first warm-up call compiles
+    parser.add_argument("--compile_update", default=False, action="store_true")
+    # per-call latency of select_action / sample_action, 0 skips it
+    parser.add_argument("--act_iters", default=0, type=int)
+    parser.add_argument("--compile_actor", default=False, action="store_true")
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--warmup", default=2, type=int)
+    parser.add_argument("--iters", default=10, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--out", default=None, type=str)
+    return parser.parse_args()
+
+
+class NullLogger(object):
+    def log(self, *args, **kwargs):
+        pass
+
+    def log_histogram(self, *args):
+        pass
+
+    def log_param(self, *args):
+        pass
+
+    def log_image(self, *args):
+        pass
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_calls(fn, args, device):
+    """Returns median / p95 ms of fn over args.iters calls after warm-up."""
+    for _ in range(args.warmup):
+        fn()
+    times = []
+    for _ in range(args.iters):
+        sync(device)
+        start = time.perf_counter()
+        fn()
+        sync(device)
+        times.append(time.perf_counter() - start)
+    return dict(
+        median_ms=1000.0 * float(np.median(times)),
+        p95_ms=1000.0 * float(np.percentile(times, 95)),
+    )
+
+
+def latency_percentiles(fn, iters, warmup, device):
+    """Returns p50 / p90 / p99 ms of single fn calls."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        sync(device)
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return dict(p50_ms=1000.0 * p50, p90_ms=1000.0 * p90, p99_ms=1000.0 * p99)
+
+
+def bench_act(args, device, compile_actor=False):
+    """Latency of the acting calls on uint8 frames and on obs / 255.0 copies."""
+    agent = RadSacAgent(
+        obs_shape=(3 * args.frame_stack, args.image_size, args.image_size),
+        action_shape=(args.action_dim,),
+        device=device,
+        hidden_dim=args.hidden_dim,
+        data_augs=args.data_augs,
+        compile_actor=compile_actor,
+    )
+    agent.train(False)
+    channels = 3 * args.frame_stack
+    frames = dict(
+        select=np.random.randint(
+            0, 256, size=(channels, args.image_size, args.image_size), dtype=np.uint8
+        ),
+        sample=np.random.randint(
+            0,
+            256,
+            size=(channels, args.pre_image_size, args.pre_image_size),
+            dtype=np.uint8,
+        ),
+    )
+    calls = dict(select=agent.select_action, sample=agent.sample_action)
+    res = {}
+    for name, act in calls.items():
+        obs = frames[name]
+        res[name] = latency_percentiles(
+            lambda: act(obs), args.act_iters, args.warmup, device
+        )
+        res[name + "_float"] = latency_percentiles(
+            lambda: act(obs / 255.0), args.act_iters, args.warmup, device
+        )
+    return res
+
+
+def make_replay_buffer(args, device):
+    channels = 3 * args.frame_stack
+    obs_shape = (channels, args.pre_image_size, args.pre_image_size)
+    capacity = 4 * args.batch_size
+    replay_buffer = utils.ReplayBuffer(
+        obs_shape=obs_shape,
+        action_shape=(args.action_dim,),
+        capacity=capacity,
+        batch_size=args.batch_size,
+        device=device,
+        image_size=args.image_size,
+        pre_image_size=args.pre_image_size,
+    )
+    for _ in range(capacity):
+        obs = np.random.randint(0, 256, size=obs_shape, dtype=np.uint8)
+        next_obs = np.random.randint(0, 256, size=obs_shape, dtype=np.uint8)
+        action = np.random.uniform(-1, 1, size=args.action_dim)
+        replay_buffer.add(obs, action, np.random.rand(), next_obs, False)
+    return replay_buffer
+
+
+def bench_q_heads(num_heads, args, device):
+    """Forward + backward of the q heads alone, ensemble vs separate QFunctions."""
+    obs = torch.randn(args.batch_size, 50, device=device)
+    action = torch.randn(args.batch_size, args.action_dim, device=device)
+    ensemble = EnsembleQFunction(50, args.action_dim, args.hidden_dim, num_heads)
+    ensemble = ensemble.to(device)
+    separate = [
+        QFunction(50, args.action_dim, args.hidden_dim).to(device)
+        for _ in range(num_heads)
+    ]
+
+    def run_ensemble():
+        ensemble(obs, action).sum().backward()
+
+    def run_separate():
+        sum(q(obs, action).sum() for q in separate).backward()
+
+    return dict(
+        ensemble=time_calls(run_ensemble, args, device),
+        separate=time_calls(run_separate, args, device),
+    )
+
+
+def bench_update(num_heads, replay_buffer, args, device, compile_update=False):
+    agent = RadSacAgent(
+        obs_shape=(3 * args.frame_stack, args.image_size, args.image_size),
+        action_shape=(args.action_dim,),
+        device=device,
+        hidden_dim=args.hidden_dim,
+        data_augs=args.data_augs,
+        num_q_heads=num_heads,
+        compile_update=compile_update,
+    )
+    L = NullLogger()
+    # step 2 runs the critic, actor and target updates with default frequencies
+    res = time_calls(lambda: agent.update(replay_buffer, L, 2), args, device)
+    res["steps_per_sec"] = 1000.0 / res["median_ms"]
+    return res
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    utils.set_seed_everywhere(args.seed)
+    replay_buffer = make_replay_buffer(args, device)
+
+    results = {}
+    for num_heads in args.num_q_heads:
+        heads = bench_q_heads(num_heads, args, device)
+        update = bench_update(num_heads, replay_buffer, args, device)
+        results["q%d" % num_heads] = dict(q_heads=heads, update=update)
+        print(
+            "%d q heads | q fwd+bwd ensemble %7.2f ms, separate %7.2f ms | update %8.2f ms (p95 %8.2f) %6.1f steps/s"
+            % (
+                num_heads,
+                heads["ensemble"]["median_ms"],
+                heads["separate"]["median_ms"],
+                update["median_ms"],
+                update["p95_ms"],
+                update["steps_per_sec"],
+            )
+        )
+        if args.compile_update:
+            compiled = bench_update(num_heads, replay_buffer, args, device, True)
+            results["q%d" % num_heads]["update_compiled"] = compiled
+            print(
+                "%d q heads | compiled update %8.2f ms (p95 %8.2f) %6.1f steps/s, x%.2f"
+                % (
+                    num_heads,
+                    compiled["median_ms"],
+                    compiled["p95_ms"],
+                    compiled["steps_per_sec"],
+                    update["median_ms"] / compiled["median_ms"],
+                )
+            )
+
+    if args.act_iters > 0:
+        modes = [("eager", False)] + (
+            [("compiled", True)] if args.compile_actor else []
+        )
+        for mode, compile_actor in modes:
+            act = bench_act(args, device, compile_actor)
+            results["act_" + mode] = act
+            for name, res in sorted(act.items()):
+                print(
+                    "%-8s %-12s p50 %6.3f ms  p90 %6.3f ms  p99 %6.3f ms"
+                    % (mode, name, res["p50_ms"], res["p90_ms"], res["p99_ms"])
+                )
+
+    if args.out:
+        meta = dict(
+            vars(args),
+            torch=torch.__version__,
+            python=platform.python_version(),
+            num_threads=torch.get_num_threads(),
+        )
+        with open(args.out, "w") as f:
+            json.dump(dict(meta=meta, results=results), f, sort_keys=True, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+import data_augs as rad
+from curl_sac import AUG_TO_FUNC
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark every data aug over batch, image and stack sizes"
+    )
+    parser.add_argument("--augs", nargs="+", default=sorted(AUG_TO_FUNC))
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[32, 128, 512])
+    parser.add_argument(
+        "--image_sizes", nargs="+", type=int, default=[64, 84, 100, 108]
+    )
+    parser.add_argument("--frame_stacks", nargs="+", type=int, default=[3])
+    parser.add_argument("--device", default="cpu", type=str)
+    # run crop / cutout / translate on uint8 tensors, as with train.py --device_augs
+    parser.add_argument("--device_augs", default=False, action="store_true")
+    parser.add_argument("--warmup", default=3, type=int)
+    parser.add_argument("--iters", default=20, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--out", default=None, type=str)
+    parser.add_argument("--baseline", default=None, type=str)
+    # allowed fractional slowdown of the median before a run counts as a regression
+    parser.add_argument("--tolerance", default=0.2, type=float)
+    return parser.parse_args()
+
+
+def result_key(aug, batch_size, image_size, frame_stack):
+    return "%s/b%d/s%d/k%d" % (aug, batch_size, image_size, frame_stack)
+
+
+def make_input(pipeline, batch_size, image_size, frame_stack, device, device_augs):
+    """Builds the (2 * B, 3 * k, S, S) obs / next_obs batch sample_rad would."""
+    shape = (2 * batch_size, 3 * frame_stack, image_size, image_size)
+    imgs = np.random.randint(0, 256, size=shape, dtype=np.uint8)
+    if pipeline.pre_stages and not device_augs:
+        return imgs
+    imgs = torch.from_numpy(imgs).to(device)
+    if pipeline.pre_stages:
+        return imgs
+    return imgs.float().div_(255.0)
+
+
+def make_step(pipeline, imgs, image_size, device):
+    # translate stages pad into a canvas 8 pixels larger than the stored frame
+    if pipeline.pre_stages:
+        return lambda: pipeline.pre_transfer(
+            imgs, image_size + 8, image_size, paired=True
+        )
+    return lambda: pipeline.post_transfer(imgs)
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def cpu_tensor_peak(step):
+    """Peak of the running sum of the cpu allocations torch.profiler records."""
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        step()
+    total = peak = 0
+    # self usage counts every allocation once, in the op that made it
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        total += event.self_cpu_memory_usage
+        peak = max(peak, total)
+    return peak
+
+
+def peak_memory_mb(step, device, on_tensors):
+    """Peak memory allocated by one step.
+
+    The cuda allocator on gpu. On cpu, tracemalloc for np.array stages and
+    torch.profiler memory events for tensor stages.
+    """
+    if device.type == "cuda":
+        sync(device)
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        step()
+        sync(device)
+        peak = torch.cuda.max_memory_allocated(device) - base
+    elif on_tensors:
+        peak = cpu_tensor_peak(step)
+    else:
+        tracemalloc.start()
+        step()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return peak / 2**20
+
+
+def matches_array_path(pipeline, imgs, image_size, device, seed):
+    """Whether uint8 tensor stages give what the np.array stages give."""
+    outs = []
+    for x in (imgs, imgs.cpu().numpy()):
+        # a fresh pipeline each, its reused buffers are either arrays or tensors
+        fresh = rad.AugPipeline(pipeline.aug_funcs, on_device=pipeline.on_device)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        out = make_step(fresh, x, image_size, device)()
+        outs.append(torch.as_tensor(out).cpu())
+    return torch.equal(*outs)
+
+
+def bench(aug, batch_size, image_size, frame_stack, args, device):
+    pipeline = rad.AugPipeline({aug: AUG_TO_FUNC[aug]}, on_device=args.device_augs)
+    imgs = make_input(
+        pipeline, batch_size, image_size, frame_stack, device, args.device_augs
+    )
+    step = make_step(pipeline, imgs, image_size, device)
+
+    for _ in range(args.warmup):
+        step()
+    times = []
+    for _ in range(args.iters):
+        sync(device)
+        start = time.perf_counter()
+        step()
+        sync(device)
+        times.append(time.perf_counter() - start)
+
+    median = float(np.median(times))
+    res = dict(
+        median_ms=1000.0 * median,
+        p95_ms=1000.0 * float(np.percentile(times, 95)),
+        throughput=batch_size / median,
+        peak_mem_mb=peak_memory_mb(step, device, isinstance(imgs, torch.Tensor)),
+    )
+    if args.device_augs and pipeline.pre_stages:
+        res["matches_numpy"] = matches_array_path(
+            pipeline, imgs, image_size, device, args.seed
+        )
+    return res
+
+
+def compare(results, baseline, tolerance):
+    """Prints the median ratio of every shared key, returns the regressed keys."""
+    regressions = []
+    for key in sorted(set(results) & set(baseline)):
+        new, old = results[key], baseline[key]
+        if "error" in new or "error" in old:
+            continue
+        ratio = new["median_ms"] / old["median_ms"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(
+            "%-40s %8.2f -> %8.2f ms  x%.2f%s"
+            % (key, old["median_ms"], new["median_ms"], ratio, flag)
+        )
+    missing = len(set(baseline) - set(results))
+    if missing:
+        print("%d baseline results were not rerun" % missing)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    results = {}
+    for aug in args.augs:
+        assert aug in AUG_TO_FUNC, "invalid data aug string"
+        for frame_stack in args.frame_stacks:
+            for image_size in args.image_sizes:
+                for batch_size in args.batch_sizes:
+                    key = result_key(aug, batch_size, image_size, frame_stack)
+                    try:
+                        res = bench(
+                            aug, batch_size, image_size, frame_stack, args, device
+                        )
+                    except Exception as e:
+                        # e.g. a crop larger than the frame, recorded and skipped
+                        results[key] = dict(error="%s: %s" % (type(e).__name__, e))
+                        print("%-40s skipped (%s)" % (key, results[key]["error"]))
+                        continue
+                    results[key] = res
+                    mem = res["peak_mem_mb"]
+                    print(
+                        "%-40s median %8.2f ms | p95 %8.2f ms | %9.0f samples/s | %s%s"
+                        % (
+                            key,
+                            res["median_ms"],
+                            res["p95_ms"],
+                            res["throughput"],
+                            "-" if mem is None else "%.1f MB" % mem,
+                            "  MISMATCH" if res.get("matches_numpy") is False else "",
+                        )
+                    )
+
+    if args.out:
+        meta = dict(
+            device=str(device),
+            device_augs=args.device_augs,
+            torch=torch.__version__,
+            numpy=np.__version__,
+            python=platform.python_version(),
+            machine=platform.machine(),
+            num_threads=torch.get_num_threads(),
+            iters=args.iters,
+        )
+        with open(args.out, "w") as f:
+            json.dump(dict(meta=meta, results=results), f, sort_keys=True, indent=4)
+
+    mismatches = [k for k, res in results.items() if res.get("matches_numpy") is False]
+    if mismatches:
+        print("%d results differ from the np.array path" % len(mismatches))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(
+                "%d regressions over %.0f%%" % (len(regressions), 100 * args.tolerance)
+            )
+            sys.exit(1)
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
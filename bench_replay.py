@@ -0,0 +1,115 @@
+import argparse
+import json
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark ReplayBuffer.add_batch against a loop over add"
+    )
+    parser.add_argument(
+        "--variants", nargs="+", default=["ram", "memmap", "dedup", "dedup_memmap"]
+    )
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[16, 64, 256])
+    parser.add_argument("--image_size", default=100, type=int)
+    parser.add_argument("--frame_stack", default=3, type=int)
+    parser.add_argument("--action_dim", default=6, type=int)
+    parser.add_argument("--capacity", default=2000, type=int)
+    # transitions written per timed run, wraps the ring when above capacity
+    parser.add_argument("--num_transitions", default=4096, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--out", default=None, type=str)
+    return parser.parse_args()
+
+
+def make_transitions(args):
+    """Consecutive frame stacks, so the dedup variants share frames as in an env."""
+    n, k, size = args.num_transitions, args.frame_stack, args.image_size
+    frames = np.random.randint(0, 256, size=(n + k, 3, size, size), dtype=np.uint8)
+    stacks = np.stack(
+        [frames[i : i + k].reshape(3 * k, size, size) for i in range(n + 1)]
+    )
+    actions = np.random.uniform(-1, 1, size=(n, args.action_dim)).astype(np.float32)
+    rewards = np.random.rand(n).astype(np.float32)
+    dones = np.zeros(n, dtype=np.float32)
+    return stacks[:-1], actions, rewards, stacks[1:], dones
+
+
+def make_buffer(variant, args, storage_dir):
+    kwargs = dict(
+        obs_shape=(3 * args.frame_stack, args.image_size, args.image_size),
+        action_shape=(args.action_dim,),
+        capacity=args.capacity,
+        batch_size=32,
+        device="cpu",
+        pre_image_size=args.image_size,
+    )
+    if "memmap" in variant:
+        kwargs["storage_dir"] = storage_dir
+    if "dedup" in variant:
+        return utils.FrameReplayBuffer(frame_stack=args.frame_stack, **kwargs)
+    return utils.ReplayBuffer(**kwargs)
+
+
+def add_loop(replay_buffer, transitions, batch_size):
+    obs, actions, rewards, next_obs, dones = transitions
+    for i in range(len(obs)):
+        replay_buffer.add(obs[i], actions[i], rewards[i], next_obs[i], dones[i])
+
+
+def add_batches(replay_buffer, transitions, batch_size):
+    for start in range(0, len(transitions[0]), batch_size):
+        replay_buffer.add_batch(*[x[start : start + batch_size] for x in transitions])
+
+
+def bench(variant, add_fn, batch_size, transitions, args):
+    storage_dir = tempfile.mkdtemp()
+    try:
+        replay_buffer = make_buffer(variant, args, storage_dir)
+        # a first pass touches every page, so both modes write to warm memory
+        add_batches(replay_buffer, transitions, args.capacity)
+        start = time.perf_counter()
+        add_fn(replay_buffer, transitions, batch_size)
+        return len(transitions[0]) / (time.perf_counter() - start)
+    finally:
+        shutil.rmtree(storage_dir)
+
+
+def main():
+    args = parse_args()
+    np.random.seed(args.seed)
+    transitions = make_transitions(args)
+
+    results = {}
+    for variant in args.variants:
+        loop = bench(variant, add_loop, 1, transitions, args)
+        results["%s/add" % variant] = dict(transitions_per_sec=loop)
+        print("%-14s add       %9.0f transitions/s" % (variant, loop))
+        for batch_size in args.batch_sizes:
+            batched = bench(variant, add_batches, batch_size, transitions, args)
+            key = "%s/add_batch%d" % (variant, batch_size)
+            results[key] = dict(transitions_per_sec=batched)
+            print(
+                "%-14s batch %-4d %9.0f transitions/s  x%.2f"
+                % (variant, batch_size, batched, batched / loop)
+            )
+
+    if args.out:
+        meta = dict(
+            vars(args),
+            numpy=np.__version__,
+            python=platform.python_version(),
+        )
+        with open(args.out, "w") as f:
+            json.dump(dict(meta=meta, results=results), f, sort_keys=True, indent=4)
+
+
+if __name__ == "__main__":
+    main()
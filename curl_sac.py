@@ -28,12 +28,16 @@ AUG_TO_FUNC = {
     "translate": dict(func=rad.random_translate, params=dict()),
     "center_crop": dict(func=rad.center_random_crop, params=dict(out=84)),
     "translate_cc": dict(func=rad.translate_center_crop, params=dict(crop_sz=100)),
+    "fused_jitter": dict(
+        func=rad.fused_color_jitter,
+        params=dict(bright=0.4, contrast=0.4, satur=0.4, hue=0.5),
+    ),
     "kornia_jitter": dict(
         func=rad.kornia_color_jitter,
         params=dict(bright=0.4, contrast=0.4, satur=0.4, hue=0.5),
     ),
-    "in_frame_translate": dict(func=rad.in_frame_translate, params=dict(size=94)),
-    "crop_translate": dict(func=rad.crop_translate, params=dict(size=100)),
+    "in_frame_translate": dict(func=rad.in_frame_translate, params=dict(size=110)),
+    "crop_translate": dict(func=rad.crop_translate, params=dict(out=84)),
     "center_crop_drac": dict(func=rad.center_crop_DrAC, params=dict(out=116)),
     "instdisc": dict(func=rad.instdisc, params=dict()),
     "no_aug": dict(func=rad.no_aug, params=dict()),
@@ -63,6 +67,13 @@ def weight_init(m):
     if isinstance(m, nn.Linear):
         nn.init.orthogonal_(m.weight.data)
         m.bias.data.fill_(0.0)
+    elif isinstance(m, EnsembleLinear):
+        # each head is initialized like its own nn.Linear
+        for weight in m.weight.data:
+            init = torch.empty(weight.t().shape)
+            nn.init.orthogonal_(init)
+            weight.copy_(init.t())
+        m.bias.data.fill_(0.0)
     elif isinstance(m, nn.Conv2d) or isinstance(m, nn.ConvTranspose2d):
         # delta-orthogonal init from https://arxiv.org/pdf/1806.05393.pdf
         assert m.weight.size(2) == m.weight.size(3)
@@ -110,11 +121,24 @@ class Actor(nn.Module):
             nn.Linear(hidden_dim, 2 * action_shape[0]),
         )
 
+        # activations are only kept while utils.record_outputs is active
         self.outputs = dict()
+        self.record_outputs = False
         self.apply(weight_init)
 
-    def forward(self, obs, compute_pi=True, compute_log_pi=True, detach_encoder=False):
-        obs = self.encoder(obs, detach=detach_encoder)
+    def forward(
+        self,
+        obs,
+        compute_pi=True,
+        compute_log_pi=True,
+        detach_encoder=False,
+        conv_features=None,
+    ):
+        # conv_features from encoder.forward_conv(obs) skip the conv stack
+        if conv_features is None:
+            obs = self.encoder(obs, detach=detach_encoder)
+        else:
+            obs = self.encoder.forward_head(conv_features)
 
         mu, log_std = self.trunk(obs).chunk(2, dim=-1)
 
@@ -124,8 +148,9 @@ class Actor(nn.Module):
             log_std + 1
         )
 
-        self.outputs["mu"] = mu
-        self.outputs["std"] = log_std.exp()
+        if self.record_outputs:
+            self.outputs["mu"] = mu
+            self.outputs["std"] = log_std.exp()
 
         if compute_pi:
             std = log_std.exp()
@@ -177,8 +202,56 @@ class QFunction(nn.Module):
         return self.trunk(obs_action)
 
 
+class EnsembleLinear(nn.Module):
+    """num_heads independent linear layers evaluated with one batched matmul."""
+
+    def __init__(self, num_heads, in_features, out_features):
+        super().__init__()
+        self.num_heads = num_heads
+        self.in_features = in_features
+        self.out_features = out_features
+        # (in, out) per head, so the forward is a plain bmm
+        self.weight = nn.Parameter(torch.empty(num_heads, in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(num_heads, 1, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same default as nn.Linear, weight_init overrides it inside the agent
+        bound = 1.0 / np.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        # x is (B, in) shared by every head, or (num_heads, B, in)
+        if x.dim() == 2:
+            x = x.expand(self.num_heads, *x.shape)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleQFunction(nn.Module):
+    """num_heads q-function MLPs stacked into one, returns (num_heads, B, 1)."""
+
+    def __init__(self, obs_dim, action_dim, hidden_dim, num_heads=2):
+        super().__init__()
+        self.num_heads = num_heads
+
+        self.trunk = nn.Sequential(
+            EnsembleLinear(num_heads, obs_dim + action_dim, hidden_dim),
+            nn.ReLU(),
+            EnsembleLinear(num_heads, hidden_dim, hidden_dim),
+            nn.ReLU(),
+            EnsembleLinear(num_heads, hidden_dim, 1),
+        )
+
+    def forward(self, obs, action):
+        assert obs.size(0) == action.size(0)
+
+        obs_action = torch.cat([obs, action], dim=1)
+        return self.trunk(obs_action)
+
+
 class Critic(nn.Module):
-    """Critic network, employes two q-functions."""
+    """Critic network, employes num_q_heads q-functions."""
 
     def __init__(
         self,
@@ -189,6 +262,7 @@ class Critic(nn.Module):
         encoder_feature_dim,
         num_layers,
         num_filters,
+        num_q_heads=2,
     ):
         super().__init__()
 
@@ -201,23 +275,43 @@ class Critic(nn.Module):
             output_logits=True,
         )
 
-        self.Q1 = QFunction(self.encoder.feature_dim, action_shape[0], hidden_dim)
-        self.Q2 = QFunction(self.encoder.feature_dim, action_shape[0], hidden_dim)
+        self.num_q_heads = num_q_heads
+        self.Q = EnsembleQFunction(
+            self.encoder.feature_dim, action_shape[0], hidden_dim, num_q_heads
+        )
 
+        # activations are only kept while utils.record_outputs is active
         self.outputs = dict()
+        self.record_outputs = False
         self.apply(weight_init)
+        self._register_load_state_dict_pre_hook(self._load_twin_q)
 
-    def forward(self, obs, action, detach_encoder=False):
+    def _load_twin_q(self, state_dict, prefix, *args):
+        """Stacks Q1 / Q2 QFunction weights from older checkpoints into Q."""
+        old = [prefix + "Q%d." % (h + 1) for h in range(self.num_q_heads)]
+        if not all(p + "trunk.0.weight" in state_dict for p in old):
+            return
+        for i in range(0, 5, 2):
+            weights = [state_dict.pop(p + "trunk.%d.weight" % i).t() for p in old]
+            biases = [state_dict.pop(p + "trunk.%d.bias" % i) for p in old]
+            key = prefix + "Q.trunk.%d." % i
+            state_dict[key + "weight"] = torch.stack(weights)
+            state_dict[key + "bias"] = torch.stack(biases).unsqueeze(1)
+
+    def forward(self, obs, action, detach_encoder=False, conv_features=None):
         # detach_encoder allows to stop gradient propogation to encoder
-        obs = self.encoder(obs, detach=detach_encoder)
-
-        q1 = self.Q1(obs, action)
-        q2 = self.Q2(obs, action)
+        # conv_features from encoder.forward_conv(obs) skip the conv stack
+        if conv_features is None:
+            obs = self.encoder(obs, detach=detach_encoder)
+        else:
+            obs = self.encoder.forward_head(conv_features)
 
-        self.outputs["q1"] = q1
-        self.outputs["q2"] = q2
+        qs = self.Q(obs, action).unbind(0)
+        if self.record_outputs:
+            for h, q in enumerate(qs):
+                self.outputs["q%d" % (h + 1)] = q
 
-        return q1, q2
+        return qs
 
     def log(self, L, step, log_freq=LOG_FREQ):
         if step % log_freq != 0:
@@ -229,8 +323,14 @@ class Critic(nn.Module):
             L.log_histogram("train_critic/%s_hist" % k, v, step)
 
         for i in range(3):
-            L.log_param("train_critic/q1_fc%d" % i, self.Q1.trunk[i * 2], step)
-            L.log_param("train_critic/q2_fc%d" % i, self.Q2.trunk[i * 2], step)
+            layer = self.Q.trunk[i * 2]
+            for h in range(self.num_q_heads):
+                # same histograms as L.log_param on one head's nn.Linear
+                key = "train_critic/q%d_fc%d" % (h + 1, i)
+                for name, param in (("w", layer.weight), ("b", layer.bias)):
+                    L.log_histogram("%s_%s" % (key, name), param.data[h], step)
+                    if param.grad is not None:
+                        L.log_histogram("%s_%s_g" % (key, name), param.grad[h], step)
 
 
 class CURL(nn.Module):
@@ -293,6 +393,9 @@ class CURL(nn.Module):
 class RadSacAgent(object):
     """RAD with SAC."""
 
+    # set to a utils.PhaseTimer to time the phases of update
+    timer = utils.NULL_TIMER
+
     def __init__(
         self,
         obs_shape,
@@ -324,6 +427,10 @@ class RadSacAgent(object):
         latent_dim=128,
         data_augs="",
         mode="",
+        device_augs=False,
+        num_q_heads=2,
+        compile_update=False,
+        compile_actor=False,
     ):
         self.device = device
         self.discount = discount
@@ -345,7 +452,9 @@ class RadSacAgent(object):
             assert aug_name in AUG_TO_FUNC, "invalid data aug string"
             self.augs_funcs[aug_name] = AUG_TO_FUNC[aug_name]
 
-        print(f"Aug set: {self.augs_funcs}")
+        self.aug_pipeline = rad.AugPipeline(self.augs_funcs, on_device=device_augs)
+
+        print(f"Aug set: {self.aug_pipeline}")
         print(f"Mode is: {self.mode}")
 
         self.actor = Actor(
@@ -368,6 +477,7 @@ class RadSacAgent(object):
             encoder_feature_dim,
             num_layers,
             num_filters,
+            num_q_heads,
         ).to(device)
 
         self.critic_target = Critic(
@@ -378,6 +488,7 @@ class RadSacAgent(object):
             encoder_feature_dim,
             num_layers,
             num_filters,
+            num_q_heads,
         ).to(device)
 
         self.critic_target.load_state_dict(self.critic.state_dict())
@@ -385,6 +496,14 @@ class RadSacAgent(object):
         # tie encoders between actor and critic, and CURL and critic
         self.actor.encoder.copy_conv_weights_from(self.critic.encoder)
 
+        # soft target updates, the parameter lists are built once here
+        self.critic_ema = utils.EMAUpdater(
+            self.critic.Q, self.critic_target.Q, self.critic_tau
+        )
+        self.encoder_ema = utils.EMAUpdater(
+            self.critic.encoder, self.critic_target.encoder, self.encoder_tau
+        )
+
         self.log_alpha = torch.tensor(np.log(init_temperature)).to(device)
         self.log_alpha.requires_grad = True
         # set target entropy to -|A|
@@ -422,6 +541,33 @@ class RadSacAgent(object):
             self.cpc_optimizer = torch.optim.Adam(self.CURL.parameters(), lr=encoder_lr)
         self.cross_entropy_loss = nn.CrossEntropyLoss()
 
+        # the loss regions and target updates have static shapes for a fixed
+        # batch size, compiled versions are used on every non-logging step
+        self.compile_update = compile_update
+        if compile_update:
+            self._critic_loss_fn = utils.CompiledFn(self._critic_loss, dynamic=False)
+            self._actor_loss_fn = utils.CompiledFn(self._actor_loss, dynamic=False)
+            self._update_targets_fn = utils.CompiledFn(
+                self._update_targets, dynamic=False
+            )
+        else:
+            self._critic_loss_fn = self._critic_loss
+            self._actor_loss_fn = self._actor_loss
+            self._update_targets_fn = self._update_targets
+
+        # acting runs batch-1 forwards on a persistent input tensor, the
+        # compiled versions see the same shapes and addresses on every call
+        self._act_obs = None
+        self._act_staging = None
+        if compile_actor:
+            self._mean_action_fn = utils.CompiledFn(self._mean_action, dynamic=False)
+            self._sampled_action_fn = utils.CompiledFn(
+                self._sampled_action, dynamic=False
+            )
+        else:
+            self._mean_action_fn = self._mean_action
+            self._sampled_action_fn = self._sampled_action
+
         self.train()
         self.critic_target.train()
 
@@ -436,37 +582,78 @@ class RadSacAgent(object):
     def alpha(self):
         return self.log_alpha.exp()
 
+    def _act_input(self, obs):
+        """Copies the batch obs into the persistent actor input.
+
+        uint8 pixels stay uint8 and are scaled by the encoder, float obs are
+        stored as float32. On cuda the copy goes through pinned memory.
+        """
+        obs = torch.as_tensor(obs)
+        dtype = torch.float32 if obs.is_floating_point() else obs.dtype
+        shape = tuple(obs.shape)
+        if (
+            self._act_obs is None
+            or self._act_obs.shape != shape
+            or self._act_obs.dtype != dtype
+        ):
+            self._act_obs = torch.empty(shape, dtype=dtype, device=self.device)
+            self._act_staging = None
+            if self._act_obs.is_cuda:
+                self._act_staging = torch.empty(shape, dtype=dtype).pin_memory()
+        if self._act_staging is None:
+            self._act_obs.copy_(obs)
+        else:
+            self._act_staging.copy_(obs)
+            self._act_obs.copy_(self._act_staging, non_blocking=True)
+        return self._act_obs
+
+    def _mean_action(self, obs):
+        mu, _, _, _ = self.actor(obs, compute_pi=False, compute_log_pi=False)
+        return mu
+
+    def _sampled_action(self, obs):
+        _, pi, _, _ = self.actor(obs, compute_log_pi=False)
+        return pi
+
     def select_action(self, obs):
-        with torch.no_grad():
-            obs = torch.FloatTensor(obs).to(self.device)
-            obs = obs.unsqueeze(0)
-            mu, _, _, _ = self.actor(obs, compute_pi=False, compute_log_pi=False)
-            return mu.cpu().data.numpy().flatten()
+        with utils.inference_mode():
+            action = self._mean_action_fn(self._act_input(obs[None]))
+            return action[0].cpu().numpy()
 
     def sample_action(self, obs):
         if obs.shape[-1] != self.image_size:
             obs = utils.center_crop_image(obs, self.image_size)
 
-        with torch.no_grad():
-            obs = torch.FloatTensor(obs).to(self.device)
-            obs = obs.unsqueeze(0)
-            mu, pi, _, _ = self.actor(obs, compute_log_pi=False)
-            return pi.cpu().data.numpy().flatten()
+        with utils.inference_mode():
+            action = self._sampled_action_fn(self._act_input(obs[None]))
+            return action[0].cpu().numpy()
 
-    def update_critic(self, obs, action, reward, next_obs, not_done, L, step):
+    def sample_actions(self, obses):
+        """sample_action for a batch of obs, one forward pass for all of them."""
+        if obses.shape[-1] != self.image_size:
+            obses = utils.center_crop_images(obses, self.image_size)
+
+        with utils.inference_mode():
+            action = self._sampled_action_fn(self._act_input(obses))
+            return action.cpu().numpy()
+
+    def _critic_loss(self, obs, action, reward, next_obs, not_done):
         with torch.no_grad():
             _, policy_action, log_pi, _ = self.actor(next_obs)
-            target_Q1, target_Q2 = self.critic_target(next_obs, policy_action)
-            target_V = torch.min(target_Q1, target_Q2) - self.alpha.detach() * log_pi
+            target_Qs = self.critic_target(next_obs, policy_action)
+            target_V = torch.stack(target_Qs).min(0)[0] - self.alpha.detach() * log_pi
             target_Q = reward + (not_done * self.discount * target_V)
 
         # get current Q estimates
-        current_Q1, current_Q2 = self.critic(
-            obs, action, detach_encoder=self.detach_encoder
-        )
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(
-            current_Q2, target_Q
+        current_Qs = self.critic(obs, action, detach_encoder=self.detach_encoder)
+        return sum(F.mse_loss(current_Q, target_Q) for current_Q in current_Qs)
+
+    def update_critic(self, obs, action, reward, next_obs, not_done, L, step):
+        # activations for critic.log are recorded by the eager forward
+        loss_fn = (
+            self._critic_loss if self.critic.record_outputs else self._critic_loss_fn
         )
+        critic_loss = loss_fn(obs, action, reward, next_obs, not_done)
         if step % self.log_interval == 0:
             L.log("train_critic/loss", critic_loss, step)
 
@@ -475,42 +662,56 @@ class RadSacAgent(object):
         critic_loss.backward()
         self.critic_optimizer.step()
 
-        # TODD!!!
-        # self.critic.log(L, step)
+        self.critic.log(L, step)
 
-    def update_actor_and_alpha(self, obs, L, step):
+    def _actor_loss(self, obs):
         # detach encoder, so we don't update it with the actor loss
-        _, pi, log_pi, log_std = self.actor(obs, detach_encoder=True)
-        actor_Q1, actor_Q2 = self.critic(obs, pi, detach_encoder=True)
+        # the actor's convs are tied to the critic's, so with both detached the
+        # conv features are computed once, without building a graph
+        with torch.no_grad():
+            conv_features = self.critic.encoder.forward_conv(obs)
+        _, pi, log_pi, log_std = self.actor(
+            obs, detach_encoder=True, conv_features=conv_features
+        )
+        actor_Qs = self.critic(
+            obs, pi, detach_encoder=True, conv_features=conv_features
+        )
 
-        actor_Q = torch.min(actor_Q1, actor_Q2)
+        actor_Q = torch.stack(actor_Qs).min(0)[0]
         actor_loss = (self.alpha.detach() * log_pi - actor_Q).mean()
-
-        if step % self.log_interval == 0:
-            L.log("train_actor/loss", actor_loss, step)
-            L.log("train_actor/target_entropy", self.target_entropy, step)
         entropy = 0.5 * log_std.shape[1] * (1.0 + np.log(2 * np.pi)) + log_std.sum(
             dim=-1
         )
-        if step % self.log_interval == 0:
-            L.log("train_actor/entropy", entropy.mean(), step)
-
-        # optimize the actor
-        self.actor_optimizer.zero_grad()
-        actor_loss.backward()
-        self.actor_optimizer.step()
+        # log_alpha is not touched by the actor step, so the alpha loss can be
+        # built from the same log_pi
+        alpha_loss = (self.alpha * (-log_pi - self.target_entropy).detach()).mean()
+        return actor_loss, alpha_loss, entropy.mean()
 
-        # TODO!!!
-        # self.actor.log(L, step)
+    def update_actor_and_alpha(self, obs, L, step):
+        loss_fn = self._actor_loss if self.actor.record_outputs else self._actor_loss_fn
+        actor_loss, alpha_loss, entropy = loss_fn(obs)
 
-        self.log_alpha_optimizer.zero_grad()
-        alpha_loss = (self.alpha * (-log_pi - self.target_entropy).detach()).mean()
         if step % self.log_interval == 0:
+            L.log("train_actor/loss", actor_loss, step)
+            L.log("train_actor/target_entropy", self.target_entropy, step)
+            L.log("train_actor/entropy", entropy, step)
             L.log("train_alpha/loss", alpha_loss, step)
             L.log("train_alpha/value", self.alpha, step)
-        alpha_loss.backward()
+
+        # optimize the actor and alpha, the losses share no parameters so a
+        # single backward through both gives the same gradients
+        self.actor_optimizer.zero_grad()
+        self.log_alpha_optimizer.zero_grad()
+        (actor_loss + alpha_loss).backward()
+        self.actor_optimizer.step()
         self.log_alpha_optimizer.step()
 
+        self.actor.log(L, step)
+
+    def _update_targets(self):
+        self.critic_ema()
+        self.encoder_ema()
+
     def update_cpc(self, obs_anchor, obs_pos, L, step):
 
         # time flips
@@ -537,45 +738,50 @@ class RadSacAgent(object):
             L.log("train/curl_loss", loss, step)
 
     def update(self, replay_buffer, L, step):
-        if self.encoder_type == "pixel":
-            if CURL_STR in self.mode:
-                (
-                    obs,
-                    action,
-                    reward,
-                    next_obs,
-                    not_done,
-                    idxs,
-                ) = replay_buffer.sample_rad(None, return_idxs=True)
+        with self.timer.span("update_sample"):
+            if self.encoder_type == "pixel":
+                if CURL_STR in self.mode:
+                    (
+                        obs,
+                        action,
+                        reward,
+                        next_obs,
+                        not_done,
+                        idxs,
+                    ) = replay_buffer.sample_rad(None, return_idxs=True)
+                else:
+                    obs, action, reward, next_obs, not_done = replay_buffer.sample_rad(
+                        self.aug_pipeline
+                    )
             else:
-                obs, action, reward, next_obs, not_done = replay_buffer.sample_rad(
-                    self.augs_funcs
-                )
-        else:
-            obs, action, reward, next_obs, not_done = replay_buffer.sample_proprio()
+                obs, action, reward, next_obs, not_done = replay_buffer.sample_proprio()
 
         if step % self.log_interval == 0:
             L.log("train/batch_reward", reward.mean(), step)
+            for name, ms in self.aug_pipeline.stats().items():
+                L.log("train/aug_%s_ms" % name, ms, step)
 
-        self.update_critic(obs, action, reward, next_obs, not_done, L, step)
+        # activations for the .log() histograms are only kept on LOG_FREQ steps
+        log_outputs = step % LOG_FREQ == 0
+        with self.timer.span("update_critic"):
+            with utils.record_outputs(self.critic, enabled=log_outputs):
+                self.update_critic(obs, action, reward, next_obs, not_done, L, step)
 
         if step % self.actor_update_freq == 0:
-            self.update_actor_and_alpha(obs, L, step)
+            with self.timer.span("update_actor"):
+                with utils.record_outputs(self.actor, enabled=log_outputs):
+                    self.update_actor_and_alpha(obs, L, step)
 
         if step % self.critic_target_update_freq == 0:
-            utils.soft_update_params(
-                self.critic.Q1, self.critic_target.Q1, self.critic_tau
-            )
-            utils.soft_update_params(
-                self.critic.Q2, self.critic_target.Q2, self.critic_tau
-            )
-            utils.soft_update_params(
-                self.critic.encoder, self.critic_target.encoder, self.encoder_tau
-            )
+            with self.timer.span("update_target"):
+                self._update_targets_fn()
 
         if step % self.cpc_update_freq == 0 and CURL_STR in self.mode:
-            obs_pos, _, _, _, _ = replay_buffer.sample_rad(self.augs_funcs, idxs=idxs)
-            self.update_cpc(obs_anchor=obs, obs_pos=obs_pos, L=L, step=step)
+            with self.timer.span("update_curl"):
+                obs_pos, _, _, _, _ = replay_buffer.sample_rad(
+                    self.aug_pipeline, idxs=idxs
+                )
+                self.update_cpc(obs_anchor=obs, obs_pos=obs_pos, L=L, step=step)
 
     def save(self, model_dir, step):
         torch.save(self.actor.state_dict(), "%s/actor_%s.pt" % (model_dir, step))
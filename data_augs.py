@@ -1,30 +1,104 @@
 import numpy as np
+import random
+import threading
+import time
 import torch
 import kornia
 import torch.nn as nn
+import torch.nn.functional as F
+from skimage.util.shape import view_as_windows
 from TransformLayer import ColorJitterLayer
 import torchvision.transforms as transforms
 
-# from utils import center_translates, center_crop_images
 from color_space import *
 
 
-def random_crop(imgs, out=84):
+def center_crop_images(image, output_size):
+    h, w = image.shape[2:]
+    new_h, new_w = output_size, output_size
+
+    top = (h - new_h) // 2
+    left = (w - new_w) // 2
+
+    image = image[:, :, top : top + new_h, left : left + new_w]
+    return image
+
+
+def zeros_like_batch(imgs, shape):
+    """np.zeros or torch.zeros of shape, with the dtype and device of imgs."""
+    if isinstance(imgs, torch.Tensor):
+        return imgs.new_zeros(shape)
+    return np.zeros(shape, dtype=imgs.dtype)
+
+
+def center_translates(image, size):
+    b, c, h, w = image.shape
+    assert size >= h and size >= w
+    outs = zeros_like_batch(image, (b, c, size, size))
+    h1 = (size - h) // 2
+    w1 = (size - w) // 2
+    outs[:, :, h1 : h1 + h, w1 : w1 + w] = image
+    return outs
+
+
+def draw_per_half(draw, n, paired=False):
+    """
+    args:
+    draw: draw(m) returns a tuple of np.arrays with m rows of aug params
+    n: batch size
+    paired: the batch is two stacked halves (e.g. obs and next_obs), each
+        half draws its params in turn as if it was augmented on its own
+    returns tuple of np.array with n rows
+    """
+    if not paired:
+        return draw(n)
+    halves = draw(n // 2), draw(n // 2)
+    return tuple(np.concatenate(params) for params in zip(*halves))
+
+
+def crop_windows(imgs, h1s, w1s, out, dst=None):
     """
     args:
-    imgs: np.array shape (B,C,H,W)
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    h1s / w1s: np.array shape (B,), top left corner of each crop
     out: output size (e.g. 84)
-    returns np.array
+    dst: optional output shape (B,C,out,out) to write the crops into
+    returns np.array or torch.tensor
+    """
+    n, c = imgs.shape[:2]
+    if isinstance(imgs, torch.Tensor):
+        # (B,C,H-out+1,W-out+1,out,out) view, gathered at each sample's corner
+        windows = imgs.unfold(2, out, 1).unfold(3, out, 1)
+        h1s = torch.as_tensor(h1s, device=imgs.device).long()
+        w1s = torch.as_tensor(w1s, device=imgs.device).long()
+        cropped = windows[torch.arange(n, device=imgs.device), :, h1s, w1s]
+        return cropped if dst is None else dst.copy_(cropped)
+    # strided view of every (C, out, out) window, no data is copied here
+    windows = view_as_windows(imgs, (1, c, out, out))[:, 0, :, :, 0]
+    cropped = windows[np.arange(n), h1s, w1s]
+    if dst is None:
+        return cropped
+    dst[...] = cropped
+    return dst
+
+
+def random_crop(imgs, out=84, dst=None, paired=False):
+    """
+    args:
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    out: output size (e.g. 84)
+    dst: optional output shape (B,C,out,out) to write the crops into
+    paired: imgs is two stacked halves that draw their offsets in turn
+    returns np.array or torch.tensor
     """
     n, c, h, w = imgs.shape
     crop_max = h - out + 1
-    w1 = np.random.randint(0, crop_max, n)
-    h1 = np.random.randint(0, crop_max, n)
-    cropped = np.empty((n, c, out, out), dtype=imgs.dtype)
-    for i, (img, w11, h11) in enumerate(zip(imgs, w1, h1)):
 
-        cropped[i] = img[:, h11 : h11 + out, w11 : w11 + out]
-    return cropped
+    def draw(m):
+        return np.random.randint(0, crop_max, m), np.random.randint(0, crop_max, m)
+
+    w1, h1 = draw_per_half(draw, n, paired)
+    return crop_windows(imgs, h1, w1, out, dst=dst)
 
 
 def random_resize_crop(imgs, min=0.5):
@@ -39,22 +113,30 @@ def center_crop_DrAC(imgs, out=116):
     return random_crop(imgs=imgs, out=h)
 
 
-def center_random_crop(imgs, out=84):
+def center_random_crop(imgs, out=84, dst=None, paired=False):
     """
     args:
-    imgs: np.array shape (B,C,H,W)
+    imgs: np.array or torch.tensor shape (B,C,H,W)
     out: output size (e.g. 84)
-    returns np.array
+    dst: optional output shape (B,C,H,W) to write the result into
+    paired: imgs is two stacked halves that draw their offsets in turn
+    returns np.array or torch.tensor
     """
     n, c, h, w = imgs.shape
     crop_max = h - out + 1
-    w1 = np.random.randint(0, crop_max, n)
-    h1 = np.random.randint(0, crop_max, n)
-    cropped = np.empty((n, c, out, out), dtype=imgs.dtype)
-    for i, (img, w11, h11) in enumerate(zip(imgs, w1, h1)):
 
-        cropped[i] = img[:, h11 : h11 + out, w11 : w11 + out]
-    return center_translates(image=cropped, size=h)
+    def draw(m):
+        return np.random.randint(0, crop_max, m), np.random.randint(0, crop_max, m)
+
+    w1, h1 = draw_per_half(draw, n, paired)
+    if dst is None:
+        dst = zeros_like_batch(imgs, (n, c, h, h))
+    else:
+        dst[...] = 0
+    # crops are written straight into the center of the zero padded output
+    pad = (h - out) // 2
+    crop_windows(imgs, h1, w1, out, dst=dst[:, :, pad : pad + out, pad : pad + out])
+    return dst
 
 
 def grayscale(imgs):
@@ -79,11 +161,12 @@ def grayscale(imgs):
     return imgs
 
 
-def random_grayscale(images, p=0.3):
+def random_grayscale(images, p=0.3, paired=False):
     """
     args:
     imgs: torch.tensor shape (B,C,H,W)
     device: cpu or cuda
+    paired: imgs is two stacked halves that draw their masks in turn
     returns torch.tensor
     """
     device = images.device
@@ -94,7 +177,9 @@ def random_grayscale(images, p=0.3):
     bs, channels, h, w = images.shape
     images = images.to(device)
     gray_images = grayscale(images)
-    rnd = np.random.uniform(0.0, 1.0, size=(images.shape[0],))
+    (rnd,) = draw_per_half(
+        lambda m: (np.random.uniform(0.0, 1.0, size=(m,)),), bs, paired
+    )
     mask = rnd <= p
     mask = torch.from_numpy(mask)
     frames = images.shape[1] // 3
@@ -111,25 +196,65 @@ def random_grayscale(images, p=0.3):
 # TODO: should mask this
 
 
-def random_cutout(imgs, min_cut=10, max_cut=30):
+def fill_boxes(imgs, h1s, w1s, value, dst=None):
     """
     args:
-    imgs: np.array shape (B,C,H,W)
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    h1s / w1s: shape (B,), each box covers rows h1:2*h1 and cols w1:2*w1
+    value: fill value, scalar or broadcastable to (B,C,1,1)
+    dst: optional output shape (B,C,H,W), may be imgs to fill in place
+    returns np.array or torch.tensor
+    """
+    _, _, h, w = imgs.shape
+    # masks only cover the area spanned by all boxes
+    top, bottom = h1s.min(), min(h, 2 * h1s.max())
+    left, right = w1s.min(), min(w, 2 * w1s.max())
+    rows = np.arange(top, bottom)
+    cols = np.arange(left, right)
+    in_rows = (rows >= h1s[:, None]) & (rows < 2 * h1s[:, None])
+    in_cols = (cols >= w1s[:, None]) & (cols < 2 * w1s[:, None])
+    mask = in_rows[:, None, :, None] & in_cols[:, None, None, :]
+
+    if isinstance(imgs, torch.Tensor):
+        mask = torch.from_numpy(mask).to(imgs.device)
+        # float fill values are truncated, like numpy assignment into uint8
+        value = torch.as_tensor(value, device=imgs.device).to(imgs.dtype)
+        if dst is None:
+            dst = imgs.clone()
+        elif dst is not imgs:
+            dst.copy_(imgs)
+        region = dst[:, :, top:bottom, left:right]
+        region.copy_(torch.where(mask, value, region))
+        return dst
+
+    if dst is None:
+        dst = imgs.copy()
+    elif dst is not imgs:
+        np.copyto(dst, imgs)
+    region = dst[:, :, top:bottom, left:right]
+    np.copyto(region, value, casting="unsafe", where=mask)
+    return dst
+
+
+def random_cutout(imgs, min_cut=10, max_cut=30, dst=None, paired=False):
+    """
+    args:
+    imgs: np.array or torch.tensor shape (B,C,H,W)
     min / max cut: int, min / max size of cutout
-    returns np.array
+    dst: optional output shape (B,C,H,W), may be imgs to cut in place
+    paired: imgs is two stacked halves that draw their boxes in turn
+    returns np.array or torch.tensor
     """
 
     n, c, h, w = imgs.shape
-    w1 = np.random.randint(min_cut, max_cut, n)
-    h1 = np.random.randint(min_cut, max_cut, n)
 
-    cutouts = np.empty((n, c, h, w), dtype=imgs.dtype)
-    for i, (img, w11, h11) in enumerate(zip(imgs, w1, h1)):
-        cut_img = img.copy()
-        cut_img[:, h11 : h11 + h11, w11 : w11 + w11] = 0
-        # print(img[:, h11:h11 + h11, w11:w11 + w11].shape)
-        cutouts[i] = cut_img
-    return cutouts
+    def draw(m):
+        w1 = np.random.randint(min_cut, max_cut, m)
+        return w1, np.random.randint(min_cut, max_cut, m)
+
+    w1, h1 = draw_per_half(draw, n, paired)
+
+    return fill_boxes(imgs, h1, w1, 0, dst=dst)
 
 
 def YDbDr(imgs):
@@ -156,148 +281,130 @@ def YIQ(imgs):
     return reshape_to_frame_stack(obs=imgs_ydbdr, frame_stack_sz=frame_stack_sz)
 
 
-def random_cutout_color(imgs, min_cut=10, max_cut=30):
+def random_cutout_color(imgs, min_cut=10, max_cut=30, dst=None, paired=False):
     """
     args:
-    imgs: shape (B,C,H,W)
-    out: output size (e.g. 84)
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    min / max cut: int, min / max size of cutout
+    dst: optional output shape (B,C,H,W), may be imgs to cut in place
+    paired: imgs is two stacked halves that draw their boxes in turn
+    returns np.array or torch.tensor
     """
 
     n, c, h, w = imgs.shape
-    w1 = np.random.randint(min_cut, max_cut, n)
-    h1 = np.random.randint(min_cut, max_cut, n)
-
-    cutouts = np.empty((n, c, h, w), dtype=imgs.dtype)
-    rand_box = np.random.randint(0, 255, size=(n, c)) / 255.0
-    for i, (img, w11, h11) in enumerate(zip(imgs, w1, h1)):
-        cut_img = img.copy()
-
-        # add random box
-        cut_img[:, h11 : h11 + h11, w11 : w11 + w11] = np.tile(
-            rand_box[i].reshape(-1, 1, 1),
-            (1,) + cut_img[:, h11 : h11 + h11, w11 : w11 + w11].shape[1:],
-        )
 
-        cutouts[i] = cut_img
-    return cutouts
+    def draw(m):
+        w1 = np.random.randint(min_cut, max_cut, m)
+        h1 = np.random.randint(min_cut, max_cut, m)
+        return w1, h1, np.random.randint(0, 255, size=(m, c))
+
+    w1, h1, rand_box = draw_per_half(draw, n, paired)
+    rand_box = rand_box / 255.0
+    return fill_boxes(imgs, h1, w1, rand_box[:, :, None, None], dst=dst)
 
 
 # random flip
 
 
-def random_flip(images, p=0.2):
+def random_flip(images, p=0.2, paired=False):
     """
     args:
     imgs: torch.tensor shape (B,C,H,W)
     device: cpu or gpu,
     p: prob of applying aug,
+    paired: imgs is two stacked halves that draw their flips in turn
     returns torch.tensor
     """
-    # images: [B, C, H, W]
-    device = images.device
-    bs, channels, h, w = images.shape
-
-    images = images.to(device)
-
-    flipped_images = images.flip([3])
-
-    rnd = np.random.uniform(0.0, 1.0, size=(images.shape[0],))
-    mask = rnd <= p
-    mask = torch.from_numpy(mask)
-    frames = images.shape[1]  # // 3
-    images = images.view(*flipped_images.shape)
-    mask = mask[:, None] * torch.ones([1, frames]).type(mask.dtype)
-
-    mask = mask.type(images.dtype).to(device)
-    mask = mask[:, :, None, None]
-
-    out = mask * flipped_images + (1 - mask) * images
-
-    out = out.view([bs, -1, h, w])
+    (rnd,) = draw_per_half(
+        lambda m: (np.random.uniform(0.0, 1.0, size=(m,)),), images.shape[0], paired
+    )
+    # copy once, then overwrite only the flipped samples
+    out = images.clone()
+    idxs = np.flatnonzero(rnd <= p)
+    if len(idxs):
+        idxs = torch.from_numpy(idxs).to(images.device)
+        out[idxs] = images[idxs].flip([3])
     return out
 
 
 # random rotation
 
 
-def random_rotation(images, p=0.3):
+def random_rotation(images, p=0.3, paired=False):
     """
     args:
     imgs: torch.tensor shape (B,C,H,W)
     device: str, cpu or gpu,
     p: float, prob of applying aug,
+    paired: imgs is two stacked halves that draw their rotations in turn
     returns torch.tensor
     """
-    device = images.device
-    # images: [B, C, H, W]
-    bs, channels, h, w = images.shape
-
-    images = images.to(device)
 
-    rot90_images = images.rot90(1, [2, 3])
-    rot180_images = images.rot90(2, [2, 3])
-    rot270_images = images.rot90(3, [2, 3])
+    def draw(m):
+        rnd = np.random.uniform(0.0, 1.0, size=(m,))
+        return rnd, np.random.randint(1, 4, size=(m,))
 
-    rnd = np.random.uniform(0.0, 1.0, size=(images.shape[0],))
-    rnd_rot = np.random.randint(1, 4, size=(images.shape[0],))
-    mask = rnd <= p
-    mask = rnd_rot * mask
-    mask = torch.from_numpy(mask).to(device)
-
-    frames = images.shape[1]
-    masks = [torch.zeros_like(mask) for _ in range(4)]
-    for i, m in enumerate(masks):
-        m[torch.where(mask == i)] = 1
-        m = m[:, None] * torch.ones([1, frames]).type(mask.dtype).type(images.dtype).to(
-            device
-        )
-        m = m[:, :, None, None]
-        masks[i] = m
-
-    out = (
-        masks[0] * images
-        + masks[1] * rot90_images
-        + masks[2] * rot180_images
-        + masks[3] * rot270_images
-    )
+    rnd, rnd_rot = draw_per_half(draw, images.shape[0], paired)
+    rot = rnd_rot * (rnd <= p)
 
-    out = out.view([bs, -1, h, w])
+    # copy once, then rotate each group of samples by its own quarter turns
+    out = images.clone()
+    for k in range(1, 4):
+        idxs = np.flatnonzero(rot == k)
+        if len(idxs):
+            idxs = torch.from_numpy(idxs).to(images.device)
+            out[idxs] = images[idxs].rot90(k, [2, 3])
     return out
 
 
 # random color
 
 
-def random_convolution(imgs):
+_CONV_KERNEL_BANKS = {}
+
+
+def xavier_conv_kernels(num, generator=None, device="cpu"):
+    """Draws num 3x3 RGB->RGB kernels, like xavier_normal_ on Conv2d(3, 3, 3)."""
+    std = (2.0 / (3 * 9 + 3 * 9)) ** 0.5
+    kernels = torch.randn(num, 3, 3, 3, 3, generator=generator) * std
+    return kernels.to(device)
+
+
+def conv_kernel_bank(size, seed=0, device="cpu"):
+    """Returns a fixed bank of size kernels drawn with seed, cached per device."""
+    key = (size, seed, str(device))
+    if key not in _CONV_KERNEL_BANKS:
+        generator = torch.Generator().manual_seed(seed)
+        _CONV_KERNEL_BANKS[key] = xavier_conv_kernels(size, generator, device)
+    return _CONV_KERNEL_BANKS[key]
+
+
+def random_convolution(imgs, bank_size=None, seed=0):
     """
     random covolution in "network randomization"
 
     (imbs): B x (C x stack) x H x W, note: imgs should be normalized and torch tensor
+    bank_size: if set, each sample picks its kernel from a fixed bank of
+    bank_size kernels drawn with seed, instead of a freshly drawn one
     """
-    _device = imgs.device
+    num_batch, num_stack_channel, img_h, img_w = imgs.shape
+    num_frames = num_stack_channel // 3
 
-    img_h, img_w = imgs.shape[2], imgs.shape[3]
-    num_stack_channel = imgs.shape[1]
-    num_batch = imgs.shape[0]
-    num_trans = num_batch
-    batch_size = int(num_batch / num_trans)
-
-    # initialize random covolution
-    rand_conv = nn.Conv2d(3, 3, kernel_size=3, bias=False, padding=1).to(_device)
+    # one kernel per sample, shared by all of its stacked frames
+    if bank_size:
+        bank = conv_kernel_bank(bank_size, seed, imgs.device)
+        kernels = bank[torch.from_numpy(np.random.randint(0, bank_size, num_batch))]
+    else:
+        kernels = xavier_conv_kernels(num_batch, device=imgs.device)
+    kernels = kernels.to(imgs.dtype).view(num_batch * 3, 3, 3, 3)
 
-    for trans_index in range(num_trans):
-        torch.nn.init.xavier_normal_(rand_conv.weight.data)
-        temp_imgs = imgs[trans_index * batch_size : (trans_index + 1) * batch_size]
-        temp_imgs = temp_imgs.reshape(
-            -1, 3, img_h, img_w
-        )  # (batch x stack, channel, h, w)
-        rand_out = rand_conv(temp_imgs)
-        if trans_index == 0:
-            total_out = rand_out
-        else:
-            total_out = torch.cat((total_out, rand_out), 0)
-    total_out = total_out.reshape(-1, num_stack_channel, img_h, img_w)
-    return total_out
+    # frames go along the batch dim and samples along the channels, so a
+    # single grouped conv applies every sample's own kernel
+    frames = imgs.view(num_batch, num_frames, 3, img_h, img_w).transpose(0, 1)
+    frames = frames.reshape(num_frames, num_batch * 3, img_h, img_w)
+    total_out = F.conv2d(frames, kernels, padding=1, groups=num_batch)
+    total_out = total_out.view(num_frames, num_batch, 3, img_h, img_w).transpose(0, 1)
+    return total_out.reshape(-1, num_stack_channel, img_h, img_w)
 
 
 def random_color_jitter(imgs, bright=0.4, contrast=0.4, satur=0.4, hue=0.5, p=1):
@@ -347,39 +454,157 @@ def kornia_color_jitter(imgs, bright=0.4, contrast=0.4, satur=0.4, hue=0.49, p=1
     return imgs.view(b, c, h, w)
 
 
-def random_translate(imgs, size, return_random_idxs=False, h1s=None, w1s=None):
+def rgb_to_hsv(r, g, b, eps=1e-8):
+    """Branch-free rgb -> hsv on channel planes, hue in [0, 1)."""
+    cmax = torch.max(torch.max(r, g), b)
+    delta = cmax - torch.min(torch.min(r, g), b)
+    inv_delta = 1.0 / (delta + eps)
+    # same priority as TransformLayer.rgb2hsv: blue, then green, then red max
+    hue = torch.where(
+        cmax == b,
+        (r - g) * inv_delta + 4,
+        torch.where(cmax == g, (b - r) * inv_delta + 2, ((g - b) * inv_delta) % 6),
+    )
+    # hue is irrelevant where saturation is 0, so cmax == 0 needs no special case
+    return hue / 6.0, delta / (cmax + eps), cmax
+
+
+def hsv_to_rgb(h, s, v):
+    """Branch-free hsv -> rgb, f(n) = v - v*s*clamp(min(k, 4 - k), 0, 1)."""
+    h6, vs = h * 6.0, v * s
+
+    def channel(n):
+        k = (h6 + n) % 6
+        return v - vs * torch.min(k, 4 - k).clamp_(0, 1)
+
+    return channel(5), channel(3), channel(1)
+
+
+def fused_color_jitter(imgs, bright=0.4, contrast=0.4, satur=0.4, hue=0.5, p=1):
+    """
+    args:
+    imgs: torch.tensor shape (B,C,H,W), normalized to [0, 1]
+    bright/contrast/satur/hue: jitter strengths as in ColorJitterLayer
+    p: probability that a sample is jittered
+    returns torch.tensor with one set of factors per sample, shared by its frames
+    """
+    b, c, h, w = imgs.shape
+    x = imgs.view(b, c // 3, 3, h, w)
+
+    def factors(lo, hi):
+        return torch.empty(b, 1, 1, 1, device=imgs.device).uniform_(lo, hi)
+
+    f_bright = factors(max(0.0, 1 - bright), 1 + bright)
+    f_contrast = factors(max(0.0, 1 - contrast), 1 + contrast).unsqueeze(-1)
+    f_satur = factors(max(0.0, 1 - satur), 1 + satur)
+    f_hue = factors(-hue, hue) * (255.0 / 360.0)
+
+    def adjust_contrast(x):
+        means = x.mean(dim=(-2, -1), keepdim=True)
+        return ((x - means) * f_contrast + means).clamp_(0, 1)
+
+    def adjust_hsv(x):
+        hh, ss, vv = rgb_to_hsv(*x.unbind(2))
+        vv = (vv * f_bright).clamp_(0, 1)
+        hh = (hh + f_hue) % 1
+        ss = (ss * f_satur).clamp_(0, 1)
+        return torch.stack(hsv_to_rgb(hh, ss, vv), dim=2).clamp_(0, 1)
+
+    # contrast goes first or last at random, as in ColorJitterLayer
+    if random.uniform(0, 1) >= 0.5:
+        out = adjust_hsv(adjust_contrast(x))
+    else:
+        out = adjust_contrast(adjust_hsv(x))
+    out = out.view(b, c, h, w)
+    if p < 1:
+        keep = torch.from_numpy(np.random.rand(b) >= p).to(imgs.device)
+        out = torch.where(keep.view(b, 1, 1, 1), imgs, out)
+    return out
+
+
+def translate_windows(imgs, size, h1s, w1s, dst=None):
+    """
+    args:
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    size: output size, at least H and W
+    h1s / w1s: shape (B,), top left corner of each image in the output
+    dst: optional output shape (B,C,size,size) that is reused
+    returns np.array or torch.tensor
+    """
+    n, c, h, w = imgs.shape
+    if isinstance(imgs, torch.Tensor):
+        return _translate_windows_torch(imgs, size, h1s, w1s, dst)
+    if dst is None:
+        dst = np.zeros((n, c, size, size), dtype=imgs.dtype)
+    else:
+        dst.fill(0)
+    # writable strided view of every (C, H, W) window of the output
+    windows = view_as_windows(dst, (1, c, h, w))[:, 0, :, :, 0]
+    windows[np.arange(n), h1s, w1s] = imgs
+    return dst
+
+
+def _translate_windows_torch(imgs, size, h1s, w1s, dst=None):
+    n, c, h, w = imgs.shape
+    h1s = torch.as_tensor(h1s, device=imgs.device).long()
+    w1s = torch.as_tensor(w1s, device=imgs.device).long()
+    if dst is None:
+        dst = imgs.new_zeros((n, c, size, size))
+    else:
+        dst.zero_()
+    sn, sc, sh, sw = dst.stride()
+    windows = dst.as_strided(
+        (n, size - h + 1, size - w + 1, c, h, w), (sn, sh, sw, sc, sh, sw)
+    )
+    windows[torch.arange(n, device=imgs.device), h1s, w1s] = imgs
+    return dst
+
+
+def random_translate(
+    imgs, size, return_random_idxs=False, h1s=None, w1s=None, dst=None, paired=False
+):
+    """
+    args:
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    size: output size, at least H and W
+    h1s / w1s: optional offsets to reuse from another call
+    dst: optional output shape (B,C,size,size) that is reused
+    paired: imgs is two stacked halves (e.g. obs and next_obs) that share
+        offsets, so only B / 2 offsets are drawn
+    returns np.array or torch.tensor
+    """
     n, c, h, w = imgs.shape
     assert size >= h and size >= w
-    outs = np.zeros((n, c, size, size), dtype=imgs.dtype)
-    h1s = np.random.randint(0, size - h + 1, n) if h1s is None else h1s
-    w1s = np.random.randint(0, size - w + 1, n) if w1s is None else w1s
-    for out, img, h1, w1 in zip(outs, imgs, h1s, w1s):
-        out[:, h1 : h1 + h, w1 : w1 + w] = img
+    m = n // 2 if paired else n
+    h1s = np.random.randint(0, size - h + 1, m) if h1s is None else h1s
+    w1s = np.random.randint(0, size - w + 1, m) if w1s is None else w1s
+    if paired:
+        outs = translate_windows(imgs, size, np.tile(h1s, 2), np.tile(w1s, 2), dst)
+    else:
+        outs = translate_windows(imgs, size, h1s, w1s, dst)
     if return_random_idxs:  # So can do the same to another set of imgs.
         return outs, dict(h1s=h1s, w1s=w1s)
     return outs
 
 
-def in_frame_translate(imgs, size, return_random_idxs=False, h1s=None, w1s=None):
+def in_frame_translate(imgs, size, return_random_idxs=False, image_size=None, **kwargs):
+    """
+    args:
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    size: canvas size of the translation, the result is cropped back to W
+    image_size: optional output size the result is centered in
+    returns np.array or torch.tensor
+    """
     _, _, _, w = imgs.shape
+    outs, dims = random_translate(
+        imgs=imgs, size=size, return_random_idxs=True, **kwargs
+    )
+    outs = center_crop_images(image=outs, output_size=w)
+    if image_size is not None:
+        outs = center_translates(outs, image_size)
     if return_random_idxs:
-        outs, dims = random_translate(
-            imgs=imgs,
-            size=size,
-            return_random_idxs=return_random_idxs,
-            h1s=h1s,
-            w1s=w1s,
-        )
-        return center_crop_images(image=outs, output_size=w), dims
-    else:
-        outs = random_translate(
-            imgs=imgs,
-            size=size,
-            return_random_idxs=return_random_idxs,
-            h1s=h1s,
-            w1s=w1s,
-        )
-        return center_crop_images(image=outs, output_size=w)
+        return outs, dims
+    return outs
 
 
 def instdisc(imgs):
@@ -394,30 +619,47 @@ def instdisc(imgs):
     return imgs_flip
 
 
-def crop_translate(imgs, out, return_random_idxs=False, h1s=None, w1s=None):
+def crop_translate(
+    imgs, out, return_random_idxs=False, image_size=None, paired=False, **kwargs
+):
+    """
+    args:
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    out: size of the random crop
+    image_size: output size the crop is translated in, defaults to H
+    paired: imgs is two stacked halves, the crops draw their offsets in turn
+        and the translations are shared
+    returns np.array or torch.tensor
+    """
     _, _, h, _ = imgs.shape
-    cropped_imgs = random_crop(imgs=imgs, out=out)
+    cropped_imgs = random_crop(imgs=imgs, out=out, paired=paired)
     return random_translate(
         imgs=cropped_imgs,
-        size=h,
+        size=image_size or h,
         return_random_idxs=return_random_idxs,
-        h1s=h1s,
-        w1s=w1s,
+        paired=paired,
+        **kwargs
     )
 
 
 def translate_center_crop(
-    imgs, crop_sz=100, return_random_idxs=False, h1s=None, w1s=None
+    imgs, crop_sz=100, return_random_idxs=False, image_size=None, **kwargs
 ):
+    """
+    args:
+    imgs: np.array or torch.tensor shape (B,C,H,W)
+    crop_sz: size of the center crop
+    image_size: output size the crop is translated in, defaults to H
+    returns np.array or torch.tensor
+    """
     _, _, h, _ = imgs.shape
     assert crop_sz <= h
     cropped_imgs = center_crop_images(image=imgs, output_size=crop_sz)
     return random_translate(
         imgs=cropped_imgs,
-        size=h,
+        size=image_size or h,
         return_random_idxs=return_random_idxs,
-        h1s=h1s,
-        w1s=w1s,
+        **kwargs
     )
 
 
@@ -425,70 +667,169 @@ def no_aug(x):
     return x
 
 
-if __name__ == "__main__":
-    import time
-    from tabulate import tabulate
-
-    def now():
-        return time.time()
-
-    def secs(t):
-        s = now() - t
-        tot = round((1e5 * s) / 60, 1)
-        return round(s, 3), tot
-
-    x = np.load("data_sample.npy", allow_pickle=True)
-    x = np.concatenate([x, x, x], 1)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    x = torch.from_numpy(x).to(device)
-    x = x.float() / 255.0
-
-    # crop
-    t = now()
-    random_crop(x.cpu().numpy(), 64)
-    s1, tot1 = secs(t)
-    # grayscale
-    t = now()
-    random_grayscale(x, p=0.5)
-    s2, tot2 = secs(t)
-    # normal cutout
-    t = now()
-    random_cutout(x.cpu().numpy(), 10, 30)
-    s3, tot3 = secs(t)
-    # color cutout
-    t = now()
-    random_cutout_color(x.cpu().numpy(), 10, 30)
-    s4, tot4 = secs(t)
-    # flip
-    t = now()
-    random_flip(x, p=0.5)
-    s5, tot5 = secs(t)
-    # rotate
-    t = now()
-    random_rotation(x, p=0.5)
-    s6, tot6 = secs(t)
-    # rand conv
-    t = now()
-    random_convolution(x)
-    s7, tot7 = secs(t)
-    # rand color jitter
-    t = now()
-    random_color_jitter(x)
-    s8, tot8 = secs(t)
-
-    print(
-        tabulate(
-            [
-                ["Crop", s1, tot1],
-                ["Grayscale", s2, tot2],
-                ["Normal Cutout", s3, tot3],
-                ["Color Cutout", s4, tot4],
-                ["Flip", s5, tot5],
-                ["Rotate", s6, tot6],
-                ["Rand Conv", s7, tot7],
-                ["Color Jitter", s8, tot8],
-            ],
-            headers=["Data Aug", "Time / batch (secs)", "Time / 100k steps (mins)"],
-        )
+class AugPipeline(object):
+    """Augmentations compiled once from an aug_funcs dict (name -> func, params).
+
+    Crop, cutout and translate stages run on the uint8 batch before it is
+    converted to float, the rest run on the float tensor batch. By default the
+    uint8 stages run on the np.array before it is moved to the device, with
+    on_device they run on the uint8 tensor after a single raw batch transfer.
+    Intermediate arrays are kept per thread and reused by later calls with the
+    same input shape, and every stage is timed.
+
+    A paired batch is obs and next_obs stacked. Every stage draws its random
+    params for obs first and then for next_obs, so a seed gives the same
+    result as augmenting the two halves one after the other.
+    """
+
+    # pre-transfer augs that write into a reused output array
+    REUSES_OUTPUT = (random_crop, center_random_crop, random_translate)
+    # pre-transfer augs that can work in place on an array the pipeline owns
+    IN_PLACE = (random_cutout, random_cutout_color)
+    # augs that take paired and draw the params of both halves themselves,
+    # other stochastic augs run once per half of a paired batch
+    PAIRED = (
+        random_crop,
+        center_random_crop,
+        random_cutout,
+        random_cutout_color,
+        random_grayscale,
+        random_flip,
+        random_rotation,
     )
+
+    def __init__(self, aug_funcs=None, on_device=False):
+        self.aug_funcs = aug_funcs or {}
+        self.on_device = on_device
+        self.pre_stages, self.post_stages = [], []
+        for name, func_dict in self.aug_funcs.items():
+            stage = (name, func_dict["func"], func_dict["params"])
+            if "crop" in name or "cutout" in name or "translate" in name:
+                self.pre_stages.append(stage)
+            else:
+                self.post_stages.append(stage)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def __getstate__(self):
+        # per thread buffers, the lock and the timings are not copied
+        state = self.__dict__.copy()
+        for key in ("_local", "_lock", "_time", "_calls"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def __bool__(self):
+        return bool(self.aug_funcs)
+
+    def __repr__(self):
+        return "AugPipeline(pre=%s, post=%s, on_device=%s)" % (
+            [name for name, _, _ in self.pre_stages],
+            [name for name, _, _ in self.post_stages],
+            self.on_device,
+        )
+
+    def _buffers(self):
+        if not hasattr(self._local, "buffers"):
+            self._local.buffers = {}
+        return self._local.buffers
+
+    def gather_buffer(self, shape, dtype):
+        """Returns a reusable array to gather the raw batch into."""
+        buffers = self._buffers()
+        key = ("gather", tuple(shape))
+        if key not in buffers or buffers[key].dtype != dtype:
+            buffers[key] = np.empty(shape, dtype=dtype)
+        return buffers[key]
+
+    def pre_transfer(self, imgs, image_size, pre_image_size, paired=False, owned=False):
+        """
+        args:
+        imgs: np.array or torch.tensor shape (B,C,H,W), uint8
+        image_size / pre_image_size: sizes used by the translate stages
+        paired: imgs is obs and next_obs stacked, translations share offsets
+        owned: imgs is not shared with the caller and may be written in place
+        returns np.array or torch.tensor
+        """
+        buffers = self._buffers()
+        for i, (name, func, params) in enumerate(self.pre_stages):
+            start = time.perf_counter()
+            key = (i, imgs.shape)
+            if func is random_translate:
+                imgs = center_crop_images(imgs, pre_image_size)
+                imgs = func(imgs, image_size, paired=paired, dst=buffers.get(key))
+                buffers[key] = imgs
+                owned = True
+            elif "translate" in name:
+                # the rest of the translate family also starts from the
+                # pre_image_size center and returns image_size frames
+                imgs = center_crop_images(imgs, pre_image_size)
+                imgs = func(imgs, image_size=image_size, paired=paired, **params)
+                owned = True
+            elif func in self.REUSES_OUTPUT:
+                imgs = func(imgs, dst=buffers.get(key), paired=paired, **params)
+                buffers[key] = imgs
+                owned = True
+            elif func in self.IN_PLACE:
+                dst = imgs if owned else None
+                imgs = func(imgs, dst=dst, paired=paired, **params)
+                owned = True
+            else:
+                imgs = self._apply(func, imgs, params, paired)
+            self._record(name, start)
+        return imgs
+
+    def post_transfer(self, imgs, paired=False):
+        """
+        args:
+        imgs: torch.tensor shape (B,C,H,W), normalized
+        paired: imgs is obs and next_obs stacked
+        returns torch.tensor
+        """
+        for name, func, params in self.post_stages:
+            start = time.perf_counter()
+            imgs = self._apply(func, imgs, params, paired)
+            self._record(name, start)
+        return imgs
+
+    def _apply(self, func, imgs, params, paired):
+        if not paired:
+            return func(imgs, **params)
+        if func is no_aug:
+            return imgs
+        if func in self.PAIRED:
+            return func(imgs, paired=True, **params)
+        n = imgs.shape[0] // 2
+        halves = func(imgs[:n], **params), func(imgs[n:], **params)
+        if isinstance(imgs, torch.Tensor):
+            return torch.cat(halves)
+        return np.concatenate(halves)
+
+    def _record(self, name, start):
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._time[name] = self._time.get(name, 0.0) + elapsed
+            self._calls[name] = self._calls.get(name, 0) + 1
+
+    def _reset_stats(self):
+        self._time, self._calls = {}, {}
+
+    def stats(self):
+        """Returns the mean ms per call of every stage since the last call.
+
+        Tensor stages are timed on the host, so on cuda they only include the
+        launch cost unless something in the stage synchronizes.
+        """
+        with self._lock:
+            stats = {
+                name: 1000.0 * self._time[name] / self._calls[name]
+                for name in self._time
+            }
+            self._reset_stats()
+        return stats
@@ -40,7 +40,9 @@ class PixelEncoder(nn.Module):
         self.fc = nn.Linear(num_filters * out_dim * out_dim, self.feature_dim)
         self.ln = nn.LayerNorm(self.feature_dim)
 
+        # activations are only kept while utils.record_outputs is active
         self.outputs = dict()
+        self.record_outputs = False
         self.output_logits = output_logits
 
     def reparameterize(self, mu, logstd):
@@ -49,17 +51,19 @@ class PixelEncoder(nn.Module):
         return mu + eps * std
 
     def forward_conv(self, obs):
-        if obs.max() > 1.:
-            obs = obs / 255.
+        # uint8 pixels are scaled here, float obs must already be in [0, 1]
+        if obs.dtype == torch.uint8:
+            obs = obs.float().div_(255.)
 
-        self.outputs['obs'] = obs
+        outputs = self.outputs if self.record_outputs else dict()
+        outputs['obs'] = obs
 
         conv = torch.relu(self.convs[0](obs))
-        self.outputs['conv1'] = conv
+        outputs['conv1'] = conv
 
         for i in range(1, self.num_layers):
             conv = torch.relu(self.convs[i](conv))
-            self.outputs['conv%s' % (i + 1)] = conv
+            outputs['conv%s' % (i + 1)] = conv
 
         h = conv.view(conv.size(0), -1)
         return h
@@ -70,17 +74,22 @@ class PixelEncoder(nn.Module):
         if detach:
             h = h.detach()
 
+        return self.forward_head(h)
+
+    def forward_head(self, h):
+        """Maps flattened conv features from forward_conv to the feature vector."""
+        outputs = self.outputs if self.record_outputs else dict()
         h_fc = self.fc(h)
-        self.outputs['fc'] = h_fc
+        outputs['fc'] = h_fc
 
         h_norm = self.ln(h_fc)
-        self.outputs['ln'] = h_norm
+        outputs['ln'] = h_norm
 
         if self.output_logits:
             out = h_norm
         else:
             out = torch.tanh(h_norm)
-            self.outputs['tanh'] = out
+            outputs['tanh'] = out
 
         return out
 
@@ -115,6 +124,12 @@ class IdentityEncoder(nn.Module):
     def forward(self, obs, detach=False):
         return obs
 
+    def forward_conv(self, obs):
+        return obs
+
+    def forward_head(self, h):
+        return h
+
     def copy_conv_weights_from(self, source):
         pass
 
@@ -0,0 +1,188 @@
+import copy
+import queue
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from data_augs import center_crop_images, center_translates
+from vec_env import EnvPool
+
+
+class _RemoteEnv(object):
+    """Lets VideoRecorder.record render env i of an EnvPool."""
+
+    def __init__(self, pool, i):
+        self.pool = pool
+        self.i = i
+
+    def render(self, **kwargs):
+        return self.pool.render(self.i, **kwargs)
+
+
+class BatchedEvaluator(object):
+    """Runs evaluation episodes on num_envs envs with batched actor forwards.
+
+    Every step the observations of all running envs are center cropped or
+    translated as in train.run_eval and go through one actor forward. Each
+    env keeps starting episodes until num_episodes have been started.
+    """
+
+    def __init__(self, env_fn, observation_space, num_envs, args, seed=0):
+        self.args = args
+        seeds = [seed + i for i in range(num_envs)]
+        self.pool = EnvPool(env_fn, observation_space, seeds)
+
+    def _preprocess(self, obs):
+        args = self.args
+        if args.encoder_type == "pixel" and "crop" in args.data_augs:
+            obs = center_crop_images(obs, args.image_size)
+        if args.encoder_type == "pixel" and "translate" in args.data_augs:
+            # first crop the center with pre_image_size
+            obs = center_crop_images(obs, args.pre_transform_image_size)
+            # then translate cropped to center
+            obs = center_translates(obs, args.image_size)
+        return obs
+
+    def run(self, actor, num_episodes, video=None):
+        """Returns the rewards of num_episodes episodes of actor's mean action.
+
+        With video, the first episode of env 0 is recorded.
+        """
+        device = next(actor.parameters()).device
+        running = list(range(min(len(self.pool), num_episodes)))
+        started = len(running)
+        self.pool.reset(running)
+        episode_rewards = np.zeros(len(self.pool))
+        all_ep_rewards = []
+        recording = video is not None and 0 in running
+        if video is not None:
+            video.init(enabled=recording)
+
+        while running:
+            obs = torch.as_tensor(self._preprocess(self.pool.obses[running]))
+            if obs.is_floating_point():
+                obs = obs.float()
+            with torch.no_grad():
+                mu, _, _, _ = actor(
+                    obs.to(device), compute_pi=False, compute_log_pi=False
+                )
+            actions = mu.cpu().numpy()
+            results = self.pool.step(running, actions)
+            if recording:
+                video.record(_RemoteEnv(self.pool, 0))
+
+            finished, restart = [], []
+            for i, (reward, done) in zip(running, results):
+                episode_rewards[i] += reward
+                if not done:
+                    continue
+                all_ep_rewards.append(episode_rewards[i])
+                episode_rewards[i] = 0
+                if i == 0:
+                    recording = False
+                if started < num_episodes:
+                    restart.append(i)
+                    started += 1
+                else:
+                    finished.append(i)
+            if restart:
+                self.pool.reset(restart)
+            running = [i for i in running if i not in finished]
+
+        return all_ep_rewards
+
+    def close(self):
+        self.pool.close()
+
+
+def _background_eval(make_evaluator, actor, num_episodes, video, requests, results):
+    torch.set_num_threads(1)
+    evaluator = make_evaluator()
+    actor.train(False)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        step, state_dict, meta = request
+        actor.load_state_dict(state_dict)
+        start = time.time()
+        episode_rewards = evaluator.run(actor, num_episodes, video)
+        if video is not None:
+            video.save("%d.mp4" % step)
+        results.put((step, meta, episode_rewards, time.time() - start))
+    evaluator.close()
+
+
+class BackgroundEvaluator(object):
+    """Evaluates frozen actor snapshots in a separate process.
+
+    submit copies the actor weights to cpu and returns at once, training
+    continues while the snapshot is evaluated. Finished evaluations are
+    collected with poll, in the order they were submitted.
+    make_evaluator builds the BatchedEvaluator inside the process.
+    """
+
+    join_timeout = 5.0
+
+    def __init__(self, make_evaluator, actor, num_episodes, video=None):
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.pending = 0
+        # not a daemon, daemons cannot start the EnvPool workers
+        self.process = ctx.Process(
+            target=_background_eval,
+            args=(
+                make_evaluator,
+                copy.deepcopy(actor).cpu(),
+                num_episodes,
+                video,
+                self.requests,
+                self.results,
+            ),
+        )
+        self.process.start()
+
+    def submit(self, step, actor, meta=None):
+        state_dict = {
+            k: v.detach().cpu().clone() for k, v in actor.state_dict().items()
+        }
+        self.requests.put((step, state_dict, meta))
+        self.pending += 1
+
+    def poll(self, block=False):
+        """Returns (step, meta, episode_rewards, eval_time) of finished evals.
+
+        With block, waits until every submitted snapshot is evaluated.
+        """
+        finished = []
+        while self.pending > 0:
+            try:
+                finished.append(self.results.get(block=block, timeout=1.0))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(
+                        "background evaluation exited with code %s"
+                        % self.process.exitcode
+                    )
+                if block:
+                    continue
+                break
+            self.pending -= 1
+        return finished
+
+    def close(self, wait=True):
+        """Returns pending evaluations like poll, waiting for them with wait.
+
+        Without wait, or if the process does not exit after join_timeout
+        seconds, it is terminated.
+        """
+        finished = self.poll(block=True) if wait else []
+        self.requests.put(None)
+        self.process.join(timeout=self.join_timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        return finished
@@ -166,3 +166,35 @@ class Logger(object):
     def dump(self, step):
         self._train_mg.dump(step, 'train')
         self._eval_mg.dump(step, 'eval')
+
+    def dump_eval(self, step):
+        # eval results that arrive late are written at their own step
+        self._eval_mg.dump(step, 'eval')
+
+
+class EnvStepLogger(object):
+    """Logger view that records every value at the current env step.
+
+    Loops that run several agent.update calls per logged env step pass their
+    own update count to agent.update for its update frequencies, what it logs
+    still lands on the env step axis of the episode and eval metrics.
+    """
+
+    def __init__(self, L):
+        self.L = L
+        self.step = 0
+
+    def log(self, key, value, step, n=1):
+        self.L.log(key, value, self.step, n)
+
+    def log_param(self, key, param, step):
+        self.L.log_param(key, param, self.step)
+
+    def log_histogram(self, key, histogram, step):
+        self.L.log_histogram(key, histogram, self.step)
+
+    def log_image(self, key, image, step):
+        self.L.log_image(key, image, self.step)
+
+    def log_video(self, key, frames, step):
+        self.L.log_video(key, frames, self.step)
@@ -0,0 +1,76 @@
+import gym
+import numpy as np
+
+
+class PointMassEnv(gym.Env):
+    """Pure numpy stand-in for a dmc2gym env, runs without MuJoCo.
+
+    A point mass in [-1, 1]^2 is pushed by a 2-d force, the reward of a
+    simulation step falls linearly from 1 at the origin to 0 at distance 1.
+    Pixel observations are (3, height, width) uint8 renders of the mass,
+    state observations its position and velocity. Episodes end after 1000
+    simulation steps as in dm_control.
+    """
+
+    def __init__(self, from_pixels=True, height=84, width=84, frame_skip=1, seed=None):
+        self._from_pixels = from_pixels
+        self._height = height
+        self._width = width
+        self._frame_skip = frame_skip
+        self._max_episode_steps = (1000 + frame_skip - 1) // frame_skip
+        self.action_space = gym.spaces.Box(-1.0, 1.0, (2,), dtype=np.float32)
+        if from_pixels:
+            self.observation_space = gym.spaces.Box(
+                0, 255, (3, height, width), dtype=np.uint8
+            )
+        else:
+            self.observation_space = gym.spaces.Box(
+                -np.inf, np.inf, (4,), dtype=np.float32
+            )
+        self._pos = np.zeros(2)
+        self._vel = np.zeros(2)
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self._rng = np.random.RandomState(seed)
+        self.action_space.seed(seed)
+
+    def _get_obs(self):
+        if self._from_pixels:
+            return (
+                self.render(height=self._height, width=self._width)
+                .transpose(2, 0, 1)
+                .copy()
+            )
+        return np.concatenate([self._pos, self._vel]).astype(np.float32)
+
+    def reset(self):
+        self._pos = self._rng.uniform(-1.0, 1.0, 2)
+        self._vel = np.zeros(2)
+        self._step = 0
+        return self._get_obs()
+
+    def step(self, action):
+        action = np.clip(action, -1.0, 1.0)
+        reward = 0.0
+        for _ in range(self._frame_skip):
+            self._vel = 0.95 * self._vel + 0.01 * action
+            self._pos = np.clip(self._pos + self._vel, -1.0, 1.0)
+            reward += max(0.0, 1.0 - np.linalg.norm(self._pos))
+        self._step += 1
+        done = self._step >= self._max_episode_steps
+        return self._get_obs(), reward, done, {}
+
+    def render(self, mode="rgb_array", height=None, width=None, camera_id=0):
+        height = height or self._height
+        width = width or self._width
+        image = np.full((height, width, 3), 40, dtype=np.uint8)
+        # the target region at the origin, then the mass on top of it
+        y, x = height // 2, width // 2
+        r = max(1, height // 20)
+        image[y - r : y + r + 1, x - r : x + r + 1] = (60, 120, 60)
+        y = int(round((self._pos[1] + 1) / 2 * (height - 1)))
+        x = int(round((self._pos[0] + 1) / 2 * (width - 1)))
+        r = max(1, height // 25)
+        image[max(0, y - r) : y + r + 1, max(0, x - r) : x + r + 1] = (220, 90, 40)
+        return image
@@ -5,10 +5,15 @@ import os
 import time
 import json
 import dmc2gym
+import functools
 import utils
+import actor_learner
+import vec_env
 from logger import Logger
 from video import VideoRecorder
 from curl_sac import RadSacAgent
+from evaluator import BatchedEvaluator, BackgroundEvaluator
+from numpy_env import PointMassEnv
 
 
 def parse_args():
@@ -24,14 +29,25 @@ def parse_args():
     parser.add_argument("--frame_stack", default=3, type=int)
     # replay buffer
     parser.add_argument("--replay_buffer_capacity", default=100000, type=int)
+    parser.add_argument("--dedup_frames", default=False, action="store_true")
+    parser.add_argument("--memmap_buffer", default=False, action="store_true")
+    parser.add_argument("--prefetch_batches", default=0, type=int)
+    parser.add_argument("--prefetch_workers", default=1, type=int)
     # train
     parser.add_argument("--agent", default="rad_sac", type=str)
     parser.add_argument("--init_steps", default=1000, type=int)
     parser.add_argument("--num_train_steps", default=1000000, type=int)
     parser.add_argument("--batch_size", default=32, type=int)
     parser.add_argument("--hidden_dim", default=1024, type=int)
+    parser.add_argument("--num_q_heads", default=2, type=int)
+    # collect on num_envs worker process envs, see vec_env.train_vectorized
+    parser.add_argument("--num_envs", default=1, type=int)
+    parser.add_argument("--update_to_data_ratio", default=1.0, type=float)
     # eval
     parser.add_argument("--eval_freq", default=1000, type=int)
+    # evaluate on eval_envs worker process envs, 0 runs on the training env
+    parser.add_argument("--eval_envs", default=0, type=int)
+    parser.add_argument("--eval_background", default=False, action="store_true")
     parser.add_argument("--num_eval_episodes", default=10, type=int)
     # critic
     parser.add_argument("--critic_lr", default=1e-3, type=float)
@@ -72,7 +88,25 @@ def parse_args():
     # data augs
     parser.add_argument("--mode", default="", type=str)
     parser.add_argument("--data_augs", default="crop", type=str)
+    # run crop / cutout / translate on the device after the raw batch transfer
+    parser.add_argument("--device_augs", default=False, action="store_true")
+    # torch.compile the critic / actor losses and target updates
+    parser.add_argument("--compile_update", default=False, action="store_true")
+    # torch.compile the actor forwards of select_action / sample_action(s)
+    parser.add_argument("--compile_actor", default=False, action="store_true")
     parser.add_argument("--log_interval", default=100, type=int)
+    # profiling
+    parser.add_argument("--profile", default=False, action="store_true")
+    parser.add_argument("--profile_sync", default=False, action="store_true")
+    parser.add_argument("--profile_trace_steps", default=0, type=int)
+    # asynchronous collection, see actor_learner.train_async
+    parser.add_argument("--async_actors", default=0, type=int)
+    parser.add_argument("--async_chunk_len", default=16, type=int)
+    parser.add_argument("--async_queue_chunks", default=32, type=int)
+    parser.add_argument("--async_publish_interval", default=100, type=int)
+    parser.add_argument("--async_max_policy_lag", default=1, type=int)
+    parser.add_argument("--async_min_update_ratio", default=0.0, type=float)
+    parser.add_argument("--async_max_update_ratio", default=1.0, type=float)
     args = parser.parse_args()
     return args
 
@@ -93,9 +127,9 @@ def run_eval(env, agent, video, video_enabled, args, sample_stochastically=False
             obs = utils.center_translate(obs, args.image_size)
         with utils.eval_mode(agent):
             if sample_stochastically:
-                action = agent.sample_action(obs / 255.0)
+                action = agent.sample_action(obs)
             else:
-                action = agent.select_action(obs / 255.0)
+                action = agent.select_action(obs)
             obs, reward, done, _ = env.step(action)
             video.record(env)
             episode_reward += reward
@@ -103,57 +137,143 @@ def run_eval(env, agent, video, video_enabled, args, sample_stochastically=False
     return episode_reward
 
 
-def evaluate(env, agent, video, num_episodes, L, step, args, work_dir):
+def log_eval_scores(all_ep_rewards, eval_time, L, step, args, work_dir, prefix=""):
+    for episode_reward in all_ep_rewards:
+        L.log("eval/" + prefix + "episode_reward", episode_reward, step)
+
+    L.log("eval/" + prefix + "eval_time", eval_time, step)
+    mean_ep_reward = np.mean(all_ep_rewards)
+    best_ep_reward = np.max(all_ep_rewards)
+    std_ep_reward = np.std(all_ep_rewards)
+    L.log("eval/" + prefix + "mean_episode_reward", mean_ep_reward, step)
+    L.log("eval/" + prefix + "best_episode_reward", best_ep_reward, step)
+
+    filename = os.path.join(work_dir, "eval_scores.npy")
+    key = args.domain_name + "-" + args.task_name + "-" + args.data_augs
+    try:
+        log_data = np.load(filename, allow_pickle=True)
+        log_data = log_data.item()
+    except:
+        log_data = {}
+
+    if key not in log_data:
+        log_data[key] = {}
+
+    log_data[key][step] = {}
+    log_data[key][step]["step"] = step
+    log_data[key][step]["mean_ep_reward"] = mean_ep_reward
+    log_data[key][step]["max_ep_reward"] = best_ep_reward
+    log_data[key][step]["std_ep_reward"] = std_ep_reward
+    log_data[key][step]["env_step"] = step * args.action_repeat
+
+    np.save(filename, log_data)
+
+
+def evaluate(
+    env, agent, video, num_episodes, L, step, args, work_dir, batched_eval=None
+):
     all_ep_rewards = []
 
     def run_eval_loop(sample_stochastically=True):
         start_time = time.time()
         prefix = "stochastic_" if sample_stochastically else ""
-        for i in range(num_episodes):
-            episode_reward = run_eval(
-                env=env,
-                agent=agent,
-                video=video,
-                video_enabled=i == 1,
-                args=args,
-                sample_stochastically=sample_stochastically,
-            )
-
+        if batched_eval is not None:
+            # one actor forward per step over all eval envs, mean actions only
+            with utils.eval_mode(agent):
+                all_ep_rewards.extend(
+                    batched_eval.run(agent.actor, num_episodes, video)
+                )
             video.save("%d.mp4" % step)
-            L.log("eval/" + prefix + "episode_reward", episode_reward, step)
-            all_ep_rewards.append(episode_reward)
-
-        L.log("eval/" + prefix + "eval_time", time.time() - start_time, step)
-        mean_ep_reward = np.mean(all_ep_rewards)
-        best_ep_reward = np.max(all_ep_rewards)
-        std_ep_reward = np.std(all_ep_rewards)
-        L.log("eval/" + prefix + "mean_episode_reward", mean_ep_reward, step)
-        L.log("eval/" + prefix + "best_episode_reward", best_ep_reward, step)
-
-        filename = os.path.join(work_dir, "eval_scores.npy")
-        key = args.domain_name + "-" + args.task_name + "-" + args.data_augs
-        try:
-            log_data = np.load(filename, allow_pickle=True)
-            log_data = log_data.item()
-        except:
-            log_data = {}
-
-        if key not in log_data:
-            log_data[key] = {}
-
-        log_data[key][step] = {}
-        log_data[key][step]["step"] = step
-        log_data[key][step]["mean_ep_reward"] = mean_ep_reward
-        log_data[key][step]["max_ep_reward"] = best_ep_reward
-        log_data[key][step]["std_ep_reward"] = std_ep_reward
-        log_data[key][step]["env_step"] = step * args.action_repeat
-
-        np.save(filename, log_data)
+        else:
+            for i in range(num_episodes):
+                episode_reward = run_eval(
+                    env=env,
+                    agent=agent,
+                    video=video,
+                    video_enabled=i == 1,
+                    args=args,
+                    sample_stochastically=sample_stochastically,
+                )
+
+                video.save("%d.mp4" % step)
+                all_ep_rewards.append(episode_reward)
+
+        log_eval_scores(
+            all_ep_rewards, time.time() - start_time, L, step, args, work_dir, prefix
+        )
 
     run_eval_loop(sample_stochastically=False)
     L.dump(step)
 
 
+def make_env(args, seed=None):
+    """dmc2gym env for args, frame stacked for pixel observations."""
+    seed = args.seed if seed is None else seed
+    pre_transform_image_size = (
+        args.pre_transform_image_size if "crop" in args.data_augs else args.image_size
+    )
+    if args.domain_name == "numpy_point_mass":
+        # stand-in that runs without MuJoCo, the task name is ignored
+        env = PointMassEnv(
+            from_pixels=(args.encoder_type == "pixel"),
+            height=pre_transform_image_size,
+            width=pre_transform_image_size,
+            frame_skip=args.action_repeat,
+            seed=seed,
+        )
+    else:
+        env = dmc2gym.make(
+            domain_name=args.domain_name,
+            task_name=args.task_name,
+            seed=seed,
+            visualize_reward=False,
+            from_pixels=(args.encoder_type == "pixel"),
+            height=pre_transform_image_size,
+            width=pre_transform_image_size,
+            frame_skip=args.action_repeat,
+        )
+
+    env.seed(seed)
+
+    # stack several consecutive frames together
+    if args.encoder_type == "pixel":
+        env = utils.FrameStack(env, k=args.frame_stack)
+    return env
+
+
+def make_replay_buffer(
+    obs_shape, action_shape, args, device, pre_image_size, work_dir, episode_length
+):
+    kwargs = dict(
+        obs_shape=obs_shape,
+        action_shape=action_shape,
+        capacity=args.replay_buffer_capacity,
+        batch_size=args.batch_size,
+        device=device,
+        image_size=args.image_size,
+        pre_image_size=pre_image_size,
+    )
+    if args.memmap_buffer:
+        # reopened as-is when the run directory already holds a buffer
+        kwargs["storage_dir"] = os.path.join(work_dir, "replay_buffer")
+    if args.dedup_frames and args.encoder_type == "pixel":
+        if args.async_actors > 0:
+            # chunks of different actors interleave, so a run of transitions
+            # ends at every chunk as well as at every episode end
+            chunk_len = args.async_chunk_len
+            episode_length = max(
+                1, episode_length * chunk_len // (episode_length + chunk_len)
+            )
+        # the vectorized collector adds one transition per env in turn
+        return utils.FrameReplayBuffer(
+            frame_stack=args.frame_stack,
+            episode_length=episode_length,
+            streams=args.num_envs,
+            **kwargs,
+        )
+    return utils.ReplayBuffer(**kwargs)
+
+
 def make_agent(obs_shape, action_shape, args, device):
     if args.agent == "rad_sac":
         return RadSacAgent(
@@ -185,11 +305,101 @@ def make_agent(obs_shape, action_shape, args, device):
             latent_dim=args.latent_dim,
             data_augs=args.data_augs,
             mode=args.mode,
+            device_augs=args.device_augs,
+            num_q_heads=args.num_q_heads,
+            compile_update=args.compile_update,
+            compile_actor=args.compile_actor,
         )
     else:
         assert "agent is not supported: %s" % args.agent
 
 
+def train_sync(
+    args,
+    env,
+    agent,
+    replay_buffer,
+    sampler,
+    L,
+    evaluate,
+    poll_evals=None,
+    timer=utils.NULL_TIMER,
+    prof=None,
+):
+    """Alternates env steps and agent updates, returns the last step.
+
+    evaluate(step, episode) runs every eval_freq steps and at the last step,
+    poll_evals once per step.
+    """
+    step = 0
+    episode, episode_reward, done = 0, 0, True
+    start_time = time.time()
+
+    for step in range(args.num_train_steps):
+        # evaluate agent periodically
+        if step % args.eval_freq == 0 or step == args.num_train_steps - 1 and step > 0:
+            evaluate(step, episode)
+        if poll_evals is not None:
+            poll_evals()
+
+        if done:
+            if step > 0:
+                if step % args.log_interval == 0:
+                    L.log("train/duration", time.time() - start_time, step)
+                    L.dump(step)
+                start_time = time.time()
+            if step % args.log_interval == 0 or step == args.num_train_steps - 1:
+                L.log("train/episode_reward", episode_reward, step)
+
+            obs = env.reset()
+            done = False
+            episode_reward = 0
+            episode_step = 0
+            episode += 1
+            if step % args.log_interval == 0:
+                L.log("train/episode", episode, step)
+
+        # sample action for data collection
+        with timer.span("act"):
+            if step < args.init_steps:
+                action = env.action_space.sample()
+            else:
+                with utils.eval_mode(agent):
+                    action = agent.sample_action(obs)
+
+        # run training update
+        if step >= args.init_steps:
+            with timer.span("update"):
+                agent.update(sampler, L, step)
+            if sampler is not replay_buffer and step % args.log_interval == 0:
+                for key, value in sampler.stats().items():
+                    L.log("train/prefetch_" + key, value, step)
+
+        with timer.span("env_step"):
+            if args.encoder_type == "pixel":
+                # stack next_obs straight into the replay row add will use
+                slot = replay_buffer.next_obs_slot()
+                next_obs, reward, done, _ = env.step(action, out=slot)
+            else:
+                next_obs, reward, done, _ = env.step(action)
+
+        # allow infinit bootstrap
+        done_bool = 0 if episode_step + 1 == env._max_episode_steps else float(done)
+        episode_reward += reward
+        with timer.span("replay_add"):
+            replay_buffer.add(obs, action, reward, next_obs, done_bool)
+
+        obs = next_obs
+        episode_step += 1
+
+        if step % args.log_interval == 0:
+            timer.log(L, step)
+        if prof is not None:
+            prof.step()
+
+    return step
+
+
 def main():
     args = parse_args()
 
@@ -198,6 +408,10 @@ def main():
         for key, value in config_dict.items():
             args.__dict__[key] = value
 
+    assert (
+        args.async_actors == 0 or args.num_envs == 1
+    ), "async_actors and num_envs > 1 are exclusive"
+
     if args.seed == -1:
         args.__dict__["seed"] = np.random.randint(1, 1000000)
     utils.set_seed_everywhere(args.seed)
@@ -213,22 +427,7 @@ def main():
         args.pre_transform_image_size
     )  # record the pre transform image size for translation
 
-    env = dmc2gym.make(
-        domain_name=args.domain_name,
-        task_name=args.task_name,
-        seed=args.seed,
-        visualize_reward=False,
-        from_pixels=(args.encoder_type == "pixel"),
-        height=pre_transform_image_size,
-        width=pre_transform_image_size,
-        frame_skip=args.action_repeat,
-    )
-
-    env.seed(args.seed)
-
-    # stack several consecutive frames together
-    if args.encoder_type == "pixel":
-        env = utils.FrameStack(env, k=args.frame_stack)
+    env = make_env(args)
 
     # make directory
     ts = time.gmtime()
@@ -273,14 +472,14 @@ def main():
         obs_shape = env.observation_space.shape
         pre_aug_obs_shape = obs_shape
 
-    replay_buffer = utils.ReplayBuffer(
+    replay_buffer = make_replay_buffer(
         obs_shape=pre_aug_obs_shape,
         action_shape=action_shape,
-        capacity=args.replay_buffer_capacity,
-        batch_size=args.batch_size,
+        args=args,
         device=device,
-        image_size=args.image_size,
         pre_image_size=pre_image_size,
+        work_dir=work_dir,
+        episode_length=env._max_episode_steps,
     )
 
     agent = make_agent(
@@ -289,12 +488,61 @@ def main():
 
     L = Logger(work_dir, use_tb=args.save_tb)
 
-    episode, episode_reward, done = 0, 0, True
-    start_time = time.time()
+    # batches are sampled in the background while the agent updates
+    sampler = replay_buffer
+    if args.prefetch_batches > 0 and args.encoder_type == "pixel":
+        sampler = utils.SamplePrefetcher(
+            replay_buffer,
+            agent.aug_pipeline,
+            depth=args.prefetch_batches,
+            num_workers=args.prefetch_workers,
+        )
 
-    for step in range(args.num_train_steps):
-        # evaluate agent periodically
-        if step % args.eval_freq == 0 or step == args.num_train_steps - 1 and step > 0:
+    # per phase wall-clock stats, logged as train/prof_<phase>_ms
+    timer = utils.NULL_TIMER
+    if args.profile or args.profile_trace_steps > 0:
+        timer = utils.PhaseTimer(sync=args.profile_sync)
+        agent.timer = replay_buffer.timer = timer
+
+    # torch.profiler trace of a few update steps, viewable in tensorboard
+    prof = None
+    if args.profile_trace_steps > 0:
+        # the async learner steps prof per update, the vectorized loop per
+        # num_envs env steps, updates start after init_steps
+        wait = 0 if args.async_actors > 0 else args.init_steps // args.num_envs
+        prof = torch.profiler.profile(
+            schedule=torch.profiler.schedule(
+                wait=wait, warmup=1, active=args.profile_trace_steps
+            ),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                os.path.join(work_dir, "profile")
+            ),
+            record_shapes=True,
+        )
+        prof.start()
+
+    batched_eval, background_eval = None, None
+    if args.eval_envs > 0:
+        make_evaluator = functools.partial(
+            BatchedEvaluator,
+            functools.partial(make_env, args),
+            env.observation_space,
+            args.eval_envs,
+            args,
+            seed=args.seed + 1000,
+        )
+        if args.eval_background:
+            background_eval = BackgroundEvaluator(
+                make_evaluator, agent.actor, args.num_eval_episodes, video
+            )
+        else:
+            batched_eval = make_evaluator()
+
+    def evaluate_and_save(step, episode):
+        if background_eval is not None:
+            # scores are logged by log_background_evals once they are ready
+            background_eval.submit(step, agent.actor, meta=episode)
+        else:
             L.log("eval/episode", episode, step)
             evaluate(
                 env,
@@ -305,49 +553,82 @@ def main():
                 step,
                 args,
                 work_dir=work_dir,
+                batched_eval=batched_eval,
+            )
+        if args.save_model:
+            agent.save(checkpoint_dir, step)
+        if args.save_buffer:
+            replay_buffer.save(buffer_dir)
+        replay_buffer.flush()
+
+    def log_background_evals(finished=None):
+        if background_eval is None:
+            return
+        if finished is None:
+            finished = background_eval.poll()
+        for step, episode, all_ep_rewards, eval_time in finished:
+            L.log("eval/episode", episode, step)
+            log_eval_scores(all_ep_rewards, eval_time, L, step, args, work_dir)
+            L.dump_eval(step)
+
+    def close_evaluators(wait=True):
+        # after a training error pending background evaluations are dropped
+        if background_eval is not None:
+            log_background_evals(background_eval.close(wait))
+        if batched_eval is not None:
+            batched_eval.close()
+
+    completed = False
+    try:
+        if args.async_actors > 0:
+            step = actor_learner.train_async(
+                args,
+                functools.partial(make_env, args),
+                agent,
+                replay_buffer,
+                sampler,
+                L,
+                evaluate_and_save,
+                poll_evals=log_background_evals,
+                timer=timer,
+                prof=prof,
+            )
+        elif args.num_envs > 1:
+            step = vec_env.train_vectorized(
+                args,
+                functools.partial(make_env, args),
+                env,
+                agent,
+                replay_buffer,
+                sampler,
+                L,
+                evaluate_and_save,
+                poll_evals=log_background_evals,
+                timer=timer,
+                prof=prof,
             )
-            if args.save_model:
-                agent.save(checkpoint_dir, step)
-            if args.save_buffer:
-                replay_buffer.save(buffer_dir)
-
-        if done:
-            if step > 0:
-                if step % args.log_interval == 0:
-                    L.log("train/duration", time.time() - start_time, step)
-                    L.dump(step)
-                start_time = time.time()
-            if step % args.log_interval == 0 or step == args.num_train_steps - 1:
-                L.log("train/episode_reward", episode_reward, step)
-
-            obs = env.reset()
-            done = False
-            episode_reward = 0
-            episode_step = 0
-            episode += 1
-            if step % args.log_interval == 0:
-                L.log("train/episode", episode, step)
-
-        # sample action for data collection
-        if step < args.init_steps:
-            action = env.action_space.sample()
         else:
-            with utils.eval_mode(agent):
-                action = agent.sample_action(obs / 255.0)
-
-        # run training update
-        if step >= args.init_steps:
-            agent.update(replay_buffer, L, step)
-
-        next_obs, reward, done, _ = env.step(action)
-
-        # allow infinit bootstrap
-        done_bool = 0 if episode_step + 1 == env._max_episode_steps else float(done)
-        episode_reward += reward
-        replay_buffer.add(obs, action, reward, next_obs, done_bool)
-
-        obs = next_obs
-        episode_step += 1
+            step = train_sync(
+                args,
+                env,
+                agent,
+                replay_buffer,
+                sampler,
+                L,
+                evaluate_and_save,
+                poll_evals=log_background_evals,
+                timer=timer,
+                prof=prof,
+            )
+        timer.log(L, step)
+        L.dump(step)
+        completed = True
+    finally:
+        if sampler is not replay_buffer:
+            sampler.close()
+        if prof is not None:
+            prof.stop()
+        close_evaluators(wait=completed)
 
 
 if __name__ == "__main__":
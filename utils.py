@@ -1,14 +1,17 @@
+import contextlib
+from collections import deque
 import torch
 import numpy as np
 import torch.nn as nn
 import gym
 import os
-from collections import deque
+import json
+import queue
+import threading
 import random
 from torch.utils.data import Dataset, DataLoader
 import time
-from skimage.util.shape import view_as_windows
-from data_augs import random_crop
+from data_augs import AugPipeline, random_crop, center_crop_images, center_translates
 
 
 class eval_mode(object):
@@ -27,9 +30,183 @@ class eval_mode(object):
         return False
 
 
+class PhaseTimer(object):
+    """Accumulates wall-clock time per named phase of a training step.
+
+    Spans also open a torch.profiler record_function range, so the same phases
+    show up in traces. Cuda work is asynchronous, with sync each span waits for
+    the device on entry and exit so the time lands in the phase that queued it.
+    """
+
+    def __init__(self, sync=False):
+        self.sync = sync and torch.cuda.is_available()
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        with torch.autograd.profiler.record_function(name):
+            if self.sync:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.sync:
+                    torch.cuda.synchronize()
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self._time[name] = self._time.get(name, 0.0) + elapsed
+                    self._calls[name] = self._calls.get(name, 0) + 1
+
+    def _reset_stats(self):
+        self._time, self._calls = {}, {}
+
+    def stats(self):
+        """Returns the mean ms per call of every phase since the last call."""
+        with self._lock:
+            stats = {
+                name: 1000.0 * self._time[name] / self._calls[name]
+                for name in self._time
+            }
+            self._reset_stats()
+        return stats
+
+    def log(self, L, step):
+        for name, ms in self.stats().items():
+            L.log("train/prof_%s_ms" % name, ms, step)
+
+
+class NullTimer(object):
+    """PhaseTimer stand-in that records nothing, used when profiling is off."""
+
+    class _Span(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+    _span = _Span()
+
+    def span(self, name):
+        return self._span
+
+    def stats(self):
+        return {}
+
+    def log(self, L, step):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class EMAUpdater(object):
+    """Soft update of target_net towards net, fused over all parameters.
+
+    The parameter lists are built once, each call updates every target tensor
+    in place with target = tau * param + (1 - tau) * target.
+    """
+
+    def __init__(self, net, target_net, tau):
+        self.params = list(net.parameters())
+        self.target_params = list(target_net.parameters())
+        assert len(self.params) == len(self.target_params)
+        self.tau = tau
+
+    @torch.no_grad()
+    def __call__(self):
+        if not self.params:
+            # e.g. the identity encoder, the foreach ops reject empty lists
+            return
+        if hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(self.target_params, self.params, self.tau)
+        else:
+            torch._foreach_mul_(self.target_params, 1 - self.tau)
+            torch._foreach_add_(self.target_params, self.params, alpha=self.tau)
+
+
+class CompiledFn(object):
+    """Runs fn through torch.compile, falling back to eager fn if that fails.
+
+    Compilation happens on the first call, so only errors raised before a
+    compiled call has succeeded switch to eager, later ones propagate.
+    """
+
+    def __init__(self, fn, **compile_kwargs):
+        self.fn = fn
+        self.compile_kwargs = compile_kwargs
+        self.compiled = None
+        self.verified = False
+        if hasattr(torch, "compile"):
+            self.compiled = torch.compile(fn, **compile_kwargs)
+        else:
+            print("torch.compile is not available, %s runs eagerly" % self.name)
+
+    @property
+    def name(self):
+        return getattr(self.fn, "__qualname__", repr(self.fn))
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.fn(*args, **kwargs)
+        if self.verified:
+            return self.compiled(*args, **kwargs)
+        try:
+            out = self.compiled(*args, **kwargs)
+        except Exception as e:
+            print("torch.compile failed, %s runs eagerly: %r" % (self.name, e))
+            self.compiled = None
+            return self.fn(*args, **kwargs)
+        self.verified = True
+        return out
+
+    def __getstate__(self):
+        return dict(fn=self.fn, compile_kwargs=self.compile_kwargs)
+
+    def __setstate__(self, state):
+        self.__init__(state["fn"], **state["compile_kwargs"])
+
+
+class record_outputs(object):
+    """Lets models keep activations in .outputs for their .log() methods.
+
+    Outside the context forwards store nothing, on exit the captured tensors
+    are released again.
+    """
+
+    def __init__(self, *models, enabled=True):
+        self.models = models
+        self.enabled = enabled
+
+    def __enter__(self):
+        self.prev_states = []
+        if not self.enabled:
+            return
+        for model in self.models:
+            for module in model.modules():
+                if hasattr(module, "record_outputs"):
+                    self.prev_states.append((module, module.record_outputs))
+                    module.record_outputs = True
+
+    def __exit__(self, *args):
+        for module, state in self.prev_states:
+            module.record_outputs = state
+            if not state:
+                module.outputs = dict()
+        return False
+
+
+def inference_mode():
+    """torch.inference_mode where available (torch >= 1.9), else no_grad."""
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
 def soft_update_params(net, target_net, tau):
-    for param, target_param in zip(net.parameters(), target_net.parameters()):
-        target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
+    EMAUpdater(net, target_net, tau)()
 
 
 def set_seed_everywhere(seed):
@@ -59,9 +236,67 @@ def preprocess_obs(obs, bits=5):
     return obs
 
 
+class BatchStager(object):
+    """Moves a batch of numpy arrays to the device in a single copy.
+
+    On CUDA the arrays are packed into one reusable pinned host buffer and
+    sent with a single non-blocking transfer, then split into typed views on
+    the device. Arrays keep their dtype, so uint8 pixels cross the bus as
+    uint8. On CPU the arrays are wrapped without any copy.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self._host = None
+        self._copied = None
+
+    def __call__(self, *arrays):
+        if self.device.type != "cuda":
+            return [torch.from_numpy(np.ascontiguousarray(a)) for a in arrays]
+
+        # 16 byte alignment keeps every typed view on the device valid
+        offsets, nbytes = [], 0
+        for a in arrays:
+            offsets.append(nbytes)
+            nbytes += -(-a.nbytes // 16) * 16
+
+        if self._copied is not None:
+            # the last non-blocking copy may still be reading the host buffer
+            self._copied.synchronize()
+        if self._host is None or self._host.numel() < nbytes:
+            self._host = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+        host = self._host.numpy()
+        for a, offset in zip(arrays, offsets):
+            dst = host[offset : offset + a.nbytes].view(a.dtype).reshape(a.shape)
+            np.copyto(dst, a)
+
+        staged = self._host[:nbytes].to(self.device, non_blocking=True)
+        self._copied = torch.cuda.Event()
+        self._copied.record()
+
+        tensors = []
+        for a, offset in zip(arrays, offsets):
+            chunk = staged[offset : offset + a.nbytes]
+            dtype = torch.from_numpy(np.empty(0, dtype=a.dtype)).dtype
+            tensors.append(chunk.view(dtype).view(a.shape))
+        return tensors
+
+
+def _same_data(a, b):
+    """True if a is the very same array row as b, not just equal."""
+    return (
+        isinstance(a, np.ndarray)
+        and a.shape == b.shape
+        and a.__array_interface__["data"][0] == b.__array_interface__["data"][0]
+    )
+
+
 class ReplayBuffer(Dataset):
     """Buffer to store environment transitions."""
 
+    # set to a PhaseTimer to time the phases of sample_rad
+    timer = NULL_TIMER
+
     def __init__(
         self,
         obs_shape,
@@ -72,6 +307,8 @@ class ReplayBuffer(Dataset):
         image_size=84,
         pre_image_size=84,
         transform=None,
+        storage_dir=None,
+        read_only=False,
     ):
         self.capacity = capacity
         self.batch_size = batch_size
@@ -79,66 +316,204 @@ class ReplayBuffer(Dataset):
         self.image_size = image_size
         self.pre_image_size = pre_image_size  # for translation
         self.transform = transform
+        # with a storage_dir all arrays are np.memmap files instead of RAM
+        self.storage_dir = storage_dir
+        self.read_only = read_only
+        if storage_dir is not None:
+            os.makedirs(storage_dir, exist_ok=True)
         # the proprioceptive obs is stored as float32, pixels obs as uint8
         obs_dtype = np.float32 if len(obs_shape) == 1 else np.uint8
+        self.obs_shape = obs_shape
+        self.obs_dtype = obs_dtype
 
-        self.obses = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-        self.next_obses = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-        self.actions = np.empty((capacity, *action_shape), dtype=np.float32)
-        self.rewards = np.empty((capacity, 1), dtype=np.float32)
-        self.not_dones = np.empty((capacity, 1), dtype=np.float32)
+        self._init_obs_storage(obs_shape, obs_dtype)
+        self.actions = self._alloc("actions", (capacity, *action_shape), np.float32)
+        self.rewards = self._alloc("rewards", (capacity, 1), np.float32)
+        self.not_dones = self._alloc("not_dones", (capacity, 1), np.float32)
 
         self.idx = 0
         self.last_save = 0
         self.full = False
+        self._stagers = {}
+        # adds and the index gather of sample_rad, which SamplePrefetcher
+        # workers run while the main thread adds
+        self._lock = threading.Lock()
+        if storage_dir is not None:
+            self.refresh()
+
+    def _alloc(self, name, shape, dtype):
+        if self.storage_dir is None:
+            return np.empty(shape, dtype=dtype)
+        path = os.path.join(self.storage_dir, "%s.npy" % name)
+        if not os.path.exists(path):
+            assert not self.read_only, "no replay buffer found at %s" % path
+            return np.lib.format.open_memmap(path, "w+", dtype=dtype, shape=shape)
+        array = np.lib.format.open_memmap(path, "r" if self.read_only else "r+")
+        assert array.shape == shape and array.dtype == dtype, (
+            "%s does not match the replay buffer layout" % path
+        )
+        return array
 
-    def add(self, obs, action, reward, next_obs, done):
+    def _init_obs_storage(self, obs_shape, obs_dtype):
+        self.obses = self._alloc("obses", (self.capacity, *obs_shape), obs_dtype)
+        self.next_obses = self._alloc(
+            "next_obses", (self.capacity, *obs_shape), obs_dtype
+        )
+
+    def state_dict(self):
+        return dict(idx=self.idx, full=self.full)
 
-        np.copyto(self.obses[self.idx], obs)
-        np.copyto(self.actions[self.idx], action)
-        np.copyto(self.rewards[self.idx], reward)
-        np.copyto(self.next_obses[self.idx], next_obs)
-        np.copyto(self.not_dones[self.idx], not done)
+    def load_state_dict(self, state):
+        self.idx = state["idx"]
+        self.full = state["full"]
 
-        self.idx = (self.idx + 1) % self.capacity
-        self.full = self.full or self.idx == 0
+    def flush(self):
+        """Writes memmapped arrays and the buffer position to storage_dir."""
+        if self.storage_dir is None or self.read_only:
+            return
+        for value in self.__dict__.values():
+            if isinstance(value, np.memmap):
+                value.flush()
+        path = os.path.join(self.storage_dir, "state.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.state_dict(), f)
+        os.replace(path + ".tmp", path)
+
+    def refresh(self):
+        """Reloads the buffer position written by the last flush, if any."""
+        path = os.path.join(self.storage_dir, "state.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                self.load_state_dict(json.load(f))
+
+    def _sample_idxs(self, size):
+        if not self.full:
+            return np.random.randint(0, self.idx, size=size)
+        # skip row idx, the env step may be writing into next_obs_slot()
+        idxs = np.random.randint(0, self.capacity - 1, size=size)
+        return (self.idx + 1 + idxs) % self.capacity
+
+    def _get_obses(self, idxs, out=None):
+        return np.take(self.obses, idxs, axis=0, out=out)
+
+    def _get_next_obses(self, idxs, out=None):
+        return np.take(self.next_obses, idxs, axis=0, out=out)
+
+    def _get_obs_pair(self, idxs, out=None):
+        """Gathers obs and next_obs for idxs into one (2 * B, ...) batch."""
+        n = len(idxs)
+        if out is None:
+            out = np.empty((2 * n, *self.obs_shape), dtype=self.obs_dtype)
+        self._get_obses(idxs, out=out[:n])
+        self._get_next_obses(idxs, out=out[n:])
+        return out
+
+    def _to_device(self, *arrays):
+        # one stager per thread, so prefetch workers never share host buffers
+        thread = threading.get_ident()
+        if thread not in self._stagers:
+            self._stagers[thread] = BatchStager(self.device)
+        return self._stagers[thread](*arrays)
+
+    def next_obs_slot(self):
+        """Row the next add stores next_obs in.
+
+        Writing next_obs there directly, as FrameStack.step(action, out=slot)
+        does, lets add skip that copy. None if the buffer has no such row.
+        """
+        return self.next_obses[self.idx]
+
+    def add(self, obs, action, reward, next_obs, done):
+        with self._lock:
+            np.copyto(self.obses[self.idx], obs)
+            np.copyto(self.actions[self.idx], action)
+            np.copyto(self.rewards[self.idx], reward)
+            if not _same_data(next_obs, self.next_obses[self.idx]):
+                np.copyto(self.next_obses[self.idx], next_obs)
+            np.copyto(self.not_dones[self.idx], not done)
+
+            self.idx = (self.idx + 1) % self.capacity
+            self.full = self.full or self.idx == 0
+
+    def _write_batch(self, pairs, n):
+        """Copies n rows of every (array, values) pair from idx on, wrapping
+        around the end of the ring, then advances idx."""
+        if n > self.capacity:
+            # only the last capacity rows survive the wraparound
+            skip = n - self.capacity
+            self.idx = (self.idx + skip) % self.capacity
+            pairs = [(array, values[skip:]) for array, values in pairs]
+            n = self.capacity
+        head = min(n, self.capacity - self.idx)
+        for array, values in pairs:
+            array[self.idx : self.idx + head] = values[:head]
+            array[: n - head] = values[head:]
+        self.full = self.full or self.idx + n >= self.capacity
+        self.idx = (self.idx + n) % self.capacity
+
+    def _batch_columns(self, actions, rewards, dones):
+        n = len(actions)
+        rewards = np.asarray(rewards, dtype=np.float32).reshape(n, 1)
+        not_dones = np.logical_not(np.asarray(dones)).reshape(n, 1)
+        return actions, rewards, not_dones
+
+    def add_batch(self, obs, actions, rewards, next_obs, dones):
+        """Adds n transitions with whole-slice copies, same as n calls to add.
+
+        obs / next_obs are (n, *obs_shape), rewards and dones (n,) or (n, 1).
+        Batches larger than the capacity only keep their last transitions.
+        """
+        actions, rewards, not_dones = self._batch_columns(actions, rewards, dones)
+        with self._lock:
+            self._write_batch(
+                [
+                    (self.obses, obs),
+                    (self.actions, actions),
+                    (self.rewards, rewards),
+                    (self.next_obses, next_obs),
+                    (self.not_dones, not_dones),
+                ],
+                len(obs),
+            )
 
     def sample_proprio(self):
 
-        idxs = np.random.randint(
-            0, self.capacity if self.full else self.idx, size=self.batch_size
-        )
+        idxs = self._sample_idxs(self.batch_size)
 
-        obses = self.obses[idxs]
-        next_obses = self.next_obses[idxs]
+        obses = self._get_obses(idxs)
+        next_obses = self._get_next_obses(idxs)
 
-        obses = torch.as_tensor(obses, device=self.device).float()
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        next_obses = torch.as_tensor(next_obses, device=self.device).float()
-        not_dones = torch.as_tensor(self.not_dones[idxs], device=self.device)
-        return obses, actions, rewards, next_obses, not_dones
+        obses, actions, rewards, next_obses, not_dones = self._to_device(
+            obses,
+            self.actions[idxs],
+            self.rewards[idxs],
+            next_obses,
+            self.not_dones[idxs],
+        )
+        return obses.float(), actions, rewards, next_obses.float(), not_dones
 
     def sample_cpc(self):
-        idxs = np.random.randint(
-            0, self.capacity if self.full else self.idx, size=self.batch_size
-        )
+        idxs = self._sample_idxs(self.batch_size)
 
-        obses = self.obses[idxs]
-        next_obses = self.next_obses[idxs]
+        obses = self._get_obses(idxs)
+        next_obses = self._get_next_obses(idxs)
         pos = obses.copy()
 
         obses = random_crop(obses, self.image_size)
         next_obses = random_crop(next_obses, self.image_size)
         pos = random_crop(pos, self.image_size)
 
-        obses = torch.as_tensor(obses, device=self.device).float()
-        next_obses = torch.as_tensor(next_obses, device=self.device).float()
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        not_dones = torch.as_tensor(self.not_dones[idxs], device=self.device)
-
-        pos = torch.as_tensor(pos, device=self.device).float()
+        obses, actions, rewards, next_obses, not_dones, pos = self._to_device(
+            obses,
+            self.actions[idxs],
+            self.rewards[idxs],
+            next_obses,
+            self.not_dones[idxs],
+            pos,
+        )
+        obses, next_obses, pos = [
+            x.float().div_(255.0) for x in (obses, next_obses, pos)
+        ]
         cpc_kwargs = dict(
             obs_anchor=obses, obs_pos=pos, time_anchor=None, time_pos=None
         )
@@ -146,75 +521,80 @@ class ReplayBuffer(Dataset):
         return obses, actions, rewards, next_obses, not_dones, cpc_kwargs
 
     def sample_rad(self, aug_funcs, idxs=None, return_idxs=False, obs_only=False):
-
-        # augs specified as flags
-        # curl_sac organizes flags into aug funcs
-        # passes aug funcs into sampler
-
-        if idxs is None:
-            idxs = np.random.randint(
-                0, self.capacity if self.full else self.idx, size=self.batch_size
+        """
+        args:
+        aug_funcs: AugPipeline, or a dict of aug funcs as in AUG_TO_FUNC
+        idxs: optional transition indices, sampled uniformly if not given
+        obs_only: only obs is augmented, next_obs is returned as is
+        """
+        if not isinstance(aug_funcs, AugPipeline):
+            aug_funcs = AugPipeline(aug_funcs)
+
+        # obs and next_obs are gathered into one batch so that every aug
+        # handles both in a single call, all columns under one lock so that
+        # no add replaces a row halfway
+        with self.timer.span("sample_gather"), self._lock:
+            if idxs is None:
+                idxs = self._sample_idxs(self.batch_size)
+            n = len(idxs)
+            shape = (2 * n, *self.obs_shape)
+            batch = self._get_obs_pair(
+                idxs, out=aug_funcs.gather_buffer(shape, self.obs_dtype)
+            )
+            actions = self.actions[idxs]
+            rewards = self.rewards[idxs]
+            not_dones = self.not_dones[idxs]
+        if obs_only:
+            batch, next_obses = batch[:n], batch[n:]
+        if not aug_funcs.on_device:
+            with self.timer.span("sample_augs_pre"):
+                batch = self._pre_transfer_augs(aug_funcs, batch, obs_only)
+
+        with self.timer.span("sample_transfer"):
+            if obs_only:
+                batch, actions, rewards, next_obses, not_dones = self._to_device(
+                    batch, actions, rewards, next_obses, not_dones
+                )
+                next_obses = next_obses.float().div_(255.0)
+            else:
+                batch, actions, rewards, not_dones = self._to_device(
+                    batch, actions, rewards, not_dones
+                )
+        if aug_funcs.on_device:
+            with self.timer.span("sample_augs_pre"):
+                batch = self._pre_transfer_augs(aug_funcs, batch, obs_only)
+        # uint8 crosses the bus, the float conversion happens on the device
+        with self.timer.span("sample_augs_post"):
+            batch = aug_funcs.post_transfer(
+                batch.float().div_(255.0), paired=not obs_only
             )
 
-        obses = self.obses[idxs]
-        next_obses = self.next_obses[idxs]
-        if aug_funcs:
-            for aug, func_dict in aug_funcs.items():
-                func = func_dict["func"]
-                params = func_dict["params"]
-                # apply crop and cutout first
-                if "crop" in aug or "cutout" in aug:
-                    obses = func(obses, **params)
-
-                    if not obs_only:
-                        next_obses = func(next_obses, **params)
-                elif "translate" in aug:
-                    og_obses = center_crop_images(obses, self.pre_image_size)
-                    obses, rndm_idxs = func(
-                        og_obses, self.image_size, return_random_idxs=True
-                    )
-
-                    if not obs_only:
-                        og_next_obses = center_crop_images(
-                            next_obses, self.pre_image_size
-                        )
-                        next_obses = func(og_next_obses, self.image_size, **rndm_idxs)
-
-        obses = torch.as_tensor(obses, device=self.device).float()
-        next_obses = torch.as_tensor(next_obses, device=self.device).float()
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        not_dones = torch.as_tensor(self.not_dones[idxs], device=self.device)
-
-        obses = obses / 255.0
-        next_obses = next_obses / 255.0
-
-        # augmentations go here
-        if aug_funcs:
-            for aug, func_dict in aug_funcs.items():
-                func = func_dict["func"]
-                params = func_dict["params"]
-                # skip crop and cutout augs
-
-                if "crop" in aug or "cutout" in aug or "translate" in aug:
-                    continue
-
-                obses = func(obses, **params)
-                if not obs_only:
-                    next_obses = func(next_obses, **params)
+        obses = batch[:n]
+        if not obs_only:
+            next_obses = batch[n:]
 
         if return_idxs:
             return obses, actions, rewards, next_obses, not_dones, idxs
         else:
             return obses, actions, rewards, next_obses, not_dones
 
+    def _pre_transfer_augs(self, aug_funcs, batch, obs_only):
+        return aug_funcs.pre_transfer(
+            batch,
+            self.image_size,
+            self.pre_image_size,
+            paired=not obs_only,
+            owned=True,
+        )
+
     def save(self, save_dir):
         if self.idx == self.last_save:
             return
         path = os.path.join(save_dir, "%d_%d.pt" % (self.last_save, self.idx))
+        chunk = np.arange(self.last_save, self.idx)
         payload = [
-            self.obses[self.last_save : self.idx],
-            self.next_obses[self.last_save : self.idx],
+            self._get_obses(chunk),
+            self._get_next_obses(chunk),
             self.actions[self.last_save : self.idx],
             self.rewards[self.last_save : self.idx],
             self.not_dones[self.last_save : self.idx],
@@ -238,12 +618,12 @@ class ReplayBuffer(Dataset):
             self.idx = end
 
     def __getitem__(self, idx):
-        idx = np.random.randint(0, self.capacity if self.full else self.idx, size=1)
-        idx = idx[0]
-        obs = self.obses[idx]
+        idxs = self._sample_idxs(1)
+        idx = idxs[0]
+        obs = self._get_obses(idxs)[0]
         action = self.actions[idx]
         reward = self.rewards[idx]
-        next_obs = self.next_obses[idx]
+        next_obs = self._get_next_obses(idxs)[0]
         not_done = self.not_dones[idx]
 
         if self.transform:
@@ -256,11 +636,352 @@ class ReplayBuffer(Dataset):
         return self.capacity
 
 
+class FrameReplayBuffer(ReplayBuffer):
+    """Replay buffer that stores every env frame only once.
+
+    Instead of keeping full (3 * frame_stack, H, W) arrays for both obs and
+    next_obs, frames live in a flat ring and each transition keeps the ids of
+    the frames that make up its stacks. Stacked observations are rebuilt at
+    sample time, so this is a drop-in replacement for ReplayBuffer.
+
+    Each obs is matched against the next_obs added `streams` transitions
+    earlier, so streams envs whose transitions are added in a fixed turn
+    still share their frames.
+
+    Every transition adds one frame, and every run of transitions of a
+    stream that does not continue the previous one (a reset, or a chunk
+    from another actor) restacks up to frame_stack frames. episode_length is
+    the shortest such run and sizes the ring. When shorter runs fill it, the
+    ring doubles instead of overwriting a frame a stored transition still
+    uses. A memmapped ring is rewritten at the larger size, and reopened at
+    the size found in storage_dir.
+    """
+
+    def __init__(
+        self,
+        obs_shape,
+        action_shape,
+        capacity,
+        batch_size,
+        device,
+        image_size=84,
+        pre_image_size=84,
+        transform=None,
+        storage_dir=None,
+        read_only=False,
+        frame_stack=3,
+        frame_capacity=None,
+        episode_length=50,
+        streams=1,
+    ):
+        assert len(obs_shape) == 3 and obs_shape[0] % frame_stack == 0
+        self.frame_stack = frame_stack
+        self.streams = streams
+        # one new frame per transition plus a full stack per run, and the
+        # partial runs of every stream at both ends of the window
+        num_runs = -(-capacity // episode_length)
+        self.frame_capacity = frame_capacity or (
+            capacity + frame_stack * (num_runs + 2 * streams)
+        )
+        super().__init__(
+            obs_shape,
+            action_shape,
+            capacity,
+            batch_size,
+            device,
+            image_size=image_size,
+            pre_image_size=pre_image_size,
+            transform=transform,
+            storage_dir=storage_dir,
+            read_only=read_only,
+        )
+
+    def _init_obs_storage(self, obs_shape, obs_dtype):
+        frame_shape = (obs_shape[0] // self.frame_stack, *obs_shape[1:])
+        if self.storage_dir is not None:
+            path = os.path.join(self.storage_dir, "frames.npy")
+            if os.path.exists(path):
+                # the ring may have grown in an earlier run
+                stored = np.load(path, mmap_mode="r").shape[0]
+                self.frame_capacity = max(self.frame_capacity, stored)
+        self.frames = self._alloc(
+            "frames", (self.frame_capacity, *frame_shape), obs_dtype
+        )
+        # ids are global frame counters, the ring slot is id % frame_capacity
+        ids_shape = (self.capacity, self.frame_stack)
+        self.obs_ids = self._alloc("obs_ids", ids_shape, np.int64)
+        self.next_obs_ids = self._alloc("next_obs_ids", ids_shape, np.int64)
+        self.frame_count = 0
+        # frames before this id were lost when the ring grew
+        self._first_frame = 0
+        # next_obs ids of the last `streams` transitions, oldest first
+        self._last_ids = deque(maxlen=self.streams)
+        # transitions of the current add_batch whose ids are not stored yet
+        self._pending = 0
+
+    def state_dict(self):
+        state = super().state_dict()
+        state["frame_count"] = self.frame_count
+        state["first_frame"] = self._first_frame
+        state["last_ids"] = [ids.tolist() for ids in self._last_ids]
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.frame_count = state["frame_count"]
+        self._first_frame = state.get("first_frame", 0)
+        self._last_ids.clear()
+        for ids in state.get("last_ids", []):
+            self._last_ids.append(np.array(ids, dtype=np.int64))
+
+    def _oldest_kept_frame(self):
+        """Oldest frame id of the stored transitions that outlive this add."""
+        size = self.capacity if self.full else self.idx
+        dropped = max(0, size + self._pending + 1 - self.capacity)
+        if dropped >= size:
+            return None
+        start = self.idx if self.full else 0
+        # frame ids only grow along a stream, so the oldest frame belongs to
+        # the oldest stored transition of one of the streams
+        rows = start + dropped + np.arange(min(self.streams, size - dropped))
+        return self.obs_ids[rows % self.capacity, 0].min()
+
+    def _grow_frames(self):
+        """Moves the frames of the ring into one twice as large."""
+        old, old_capacity = self.frames, self.frame_capacity
+        self.frame_capacity = 2 * old_capacity
+        print(
+            "frame ring of %d frames is full, runs of transitions are shorter "
+            "than episode_length, growing it to %d"
+            % (old_capacity, self.frame_capacity)
+        )
+        shape = (self.frame_capacity, *old.shape[1:])
+        if self.storage_dir is None:
+            self.frames = np.empty(shape, dtype=old.dtype)
+        else:
+            path = os.path.join(self.storage_dir, "frames.npy")
+            self.frames = np.lib.format.open_memmap(
+                path + ".tmp", "w+", dtype=old.dtype, shape=shape
+            )
+        self._first_frame = max(0, self.frame_count - old_capacity)
+        ids = np.arange(self._first_frame, self.frame_count)
+        self.frames[ids % self.frame_capacity] = old[ids % old_capacity]
+        if self.storage_dir is not None:
+            self.frames.flush()
+            os.replace(path + ".tmp", path)
+
+    def _write_frame(self, frame):
+        oldest = self._oldest_kept_frame()
+        if oldest is not None and self.frame_count - self.frame_capacity >= oldest:
+            self._grow_frames()
+        np.copyto(self.frames[self.frame_count % self.frame_capacity], frame)
+        self.frame_count += 1
+        return self.frame_count - 1
+
+    def _is_live(self, ids):
+        first = max(self._first_frame, self.frame_count - self.frame_capacity)
+        return ids.min() >= first
+
+    def _gather(self, ids, out=None):
+        if out is not None:
+            out = out.reshape(*ids.shape, *self.frames.shape[1:])
+        frames = np.take(self.frames, ids % self.frame_capacity, axis=0, out=out)
+        return frames.reshape(len(ids), *self.obs_shape)
+
+    def _stack_ids(self, obs, prev_ids=None):
+        """Returns frame ids for obs, only writing frames not already stored."""
+        frames = obs.reshape(self.frame_stack, -1, *obs.shape[1:])
+        # a stack that continues prev_ids only adds its newest frame
+        if prev_ids is not None and self._is_live(prev_ids[1:]):
+            shared = self.frames[prev_ids[1:] % self.frame_capacity]
+            if np.array_equal(frames[:-1], shared):
+                return np.append(prev_ids[1:], self._write_frame(frames[-1]))
+        ids = np.empty(self.frame_stack, dtype=np.int64)
+        for i, frame in enumerate(frames):
+            # stacks after a reset repeat the first frame of the episode
+            if i > 0 and np.array_equal(frame, frames[i - 1]):
+                ids[i] = ids[i - 1]
+            else:
+                ids[i] = self._write_frame(frame)
+        return ids
+
+    def next_obs_slot(self):
+        # stacks are split into frames on add, there is no row to write into
+        return None
+
+    def _transition_ids(self, obs, next_obs):
+        obs_ids = None
+        if len(self._last_ids) == self.streams and self._is_live(self._last_ids[0]):
+            last = self._gather(self._last_ids[0][None])[0]
+            if np.array_equal(obs, last):
+                obs_ids = self._last_ids[0]
+        if obs_ids is None:
+            obs_ids = self._stack_ids(obs)
+        next_obs_ids = self._stack_ids(next_obs, prev_ids=obs_ids)
+        self._last_ids.append(next_obs_ids)
+        return obs_ids, next_obs_ids
+
+    def add(self, obs, action, reward, next_obs, done):
+        with self._lock:
+            obs_ids, next_obs_ids = self._transition_ids(obs, next_obs)
+
+            self.obs_ids[self.idx] = obs_ids
+            self.next_obs_ids[self.idx] = next_obs_ids
+            np.copyto(self.actions[self.idx], action)
+            np.copyto(self.rewards[self.idx], reward)
+            np.copyto(self.not_dones[self.idx], not done)
+
+            self.idx = (self.idx + 1) % self.capacity
+            self.full = self.full or self.idx == 0
+
+    def add_batch(self, obs, actions, rewards, next_obs, dones):
+        # frames are deduplicated against earlier transitions, so the
+        # stacks are still matched one by one, the rest is written in slices
+        n = len(obs)
+        actions, rewards, not_dones = self._batch_columns(actions, rewards, dones)
+        obs_ids = np.empty((n, self.frame_stack), dtype=np.int64)
+        next_obs_ids = np.empty((n, self.frame_stack), dtype=np.int64)
+        # the frames of rows this batch replaces are overwritten before the
+        # rows are, so samples wait for the whole batch
+        with self._lock:
+            try:
+                for i in range(n):
+                    self._pending = i
+                    obs_ids[i], next_obs_ids[i] = self._transition_ids(
+                        obs[i], next_obs[i]
+                    )
+            finally:
+                self._pending = 0
+            self._write_batch(
+                [
+                    (self.obs_ids, obs_ids),
+                    (self.next_obs_ids, next_obs_ids),
+                    (self.actions, actions),
+                    (self.rewards, rewards),
+                    (self.not_dones, not_dones),
+                ],
+                n,
+            )
+
+    def _get_obses(self, idxs, out=None):
+        return self._gather(self.obs_ids[idxs], out=out)
+
+    def _get_next_obses(self, idxs, out=None):
+        return self._gather(self.next_obs_ids[idxs], out=out)
+
+    def load(self, save_dir):
+        chunks = os.listdir(save_dir)
+        chucks = sorted(chunks, key=lambda x: int(x.split("_")[0]))
+        for chunk in chucks:
+            start, end = [int(x) for x in chunk.split(".")[0].split("_")]
+            path = os.path.join(save_dir, chunk)
+            payload = torch.load(path)
+            assert self.idx == start
+            for obs, next_obs, action, reward, not_done in zip(*payload):
+                self.add(obs, action, reward, next_obs, not not_done[0])
+
+
+class SamplePrefetcher(object):
+    """Prepares sample_rad batches in background threads.
+
+    Wraps a replay buffer and keeps up to `depth` augmented batches ready for
+    sample_rad(aug_funcs). Any other call falls through to the buffer, so the
+    prefetcher can be handed to agent.update in place of the buffer. Batches
+    may lag the newest transitions by up to `depth` steps. Workers sample
+    while the main thread adds, the buffer's lock keeps every batch row from
+    a single transition.
+    """
+
+    def __init__(self, replay_buffer, aug_funcs, depth=2, num_workers=1):
+        self.replay_buffer = replay_buffer
+        self.aug_funcs = aug_funcs
+        self.num_workers = num_workers
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._workers = []
+        self._reset_stats()
+
+    def __getattr__(self, name):
+        if name == "replay_buffer":
+            raise AttributeError(name)
+        return getattr(self.replay_buffer, name)
+
+    def _reset_stats(self):
+        self._num_gets = 0
+        self._num_waits = 0
+        self._depth_sum = 0
+        self._wait_time = 0.0
+
+    def _work(self):
+        while not self._stop.is_set():
+            batch = self.replay_buffer.sample_rad(self.aug_funcs)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def start(self):
+        for _ in range(self.num_workers):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def close(self):
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def sample_rad(self, aug_funcs, idxs=None, return_idxs=False, obs_only=False):
+        prefetched = aug_funcs is self.aug_funcs and not self._stop.is_set()
+        if not prefetched or idxs is not None or return_idxs or obs_only:
+            return self.replay_buffer.sample_rad(
+                aug_funcs, idxs=idxs, return_idxs=return_idxs, obs_only=obs_only
+            )
+        # start lazily so workers never sample from an empty buffer
+        if not self._workers:
+            self.start()
+
+        depth = self._queue.qsize()
+        self._num_gets += 1
+        self._depth_sum += depth
+        if depth == 0:
+            self._num_waits += 1
+        start = time.time()
+        batch = self._queue.get()
+        self._wait_time += time.time() - start
+        return batch
+
+    def stats(self):
+        """Returns queue stats since the last call.
+
+        A mean depth near zero with frequent waits means training is bound by
+        the sampler; a full queue means it is bound by the learner.
+        """
+        n = max(1, self._num_gets)
+        stats = dict(
+            depth=self._depth_sum / n,
+            wait_frac=self._num_waits / n,
+            wait_time=self._wait_time / n,
+        )
+        self._reset_stats()
+        return stats
+
+
 class FrameStack(gym.Wrapper):
+    """Stacks the last k frames along the channel axis.
+
+    Every frame is written to two slots of a 2k frame ring, so the newest k
+    frames are always the contiguous slice [head, head + k) and stacking is a
+    single copy. With out, e.g. ReplayBuffer.next_obs_slot(), reset and step
+    write the stack there instead of allocating a new array.
+    """
+
     def __init__(self, env, k):
         gym.Wrapper.__init__(self, env)
         self._k = k
-        self._frames = deque([], maxlen=k)
         shp = env.observation_space.shape
         self.observation_space = gym.spaces.Box(
             low=0,
@@ -269,21 +990,30 @@ class FrameStack(gym.Wrapper):
             dtype=env.observation_space.dtype,
         )
         self._max_episode_steps = env._max_episode_steps
+        self._frames = np.empty((2 * k, *shp), dtype=env.observation_space.dtype)
+        self._head = 0
 
-    def reset(self):
+    def reset(self, out=None):
         obs = self.env.reset()
-        for _ in range(self._k):
-            self._frames.append(obs)
-        return self._get_obs()
+        self._frames[:] = obs
+        self._head = 0
+        return self._get_obs(out)
 
-    def step(self, action):
+    def step(self, action, out=None):
         obs, reward, done, info = self.env.step(action)
-        self._frames.append(obs)
-        return self._get_obs(), reward, done, info
+        # overwrite the oldest frame, the stack then starts one slot later
+        self._frames[self._head] = obs
+        self._frames[self._head + self._k] = obs
+        self._head = (self._head + 1) % self._k
+        return self._get_obs(out), reward, done, info
 
-    def _get_obs(self):
-        assert len(self._frames) == self._k
-        return np.concatenate(list(self._frames), axis=0)
+    def _get_obs(self, out=None):
+        frames = self._frames[self._head : self._head + self._k]
+        stack = frames.reshape(self.observation_space.shape)
+        if out is None:
+            return stack.copy()
+        np.copyto(out, stack)
+        return out
 
 
 def center_crop_image(image, output_size):
@@ -297,17 +1027,6 @@ def center_crop_image(image, output_size):
     return image
 
 
-def center_crop_images(image, output_size):
-    h, w = image.shape[2:]
-    new_h, new_w = output_size, output_size
-
-    top = (h - new_h) // 2
-    left = (w - new_w) // 2
-
-    image = image[:, :, top : top + new_h, left : left + new_w]
-    return image
-
-
 def center_translate(image, size):
     c, h, w = image.shape
     assert size >= h and size >= w
@@ -316,13 +1035,3 @@ def center_translate(image, size):
     w1 = (size - w) // 2
     outs[:, h1 : h1 + h, w1 : w1 + w] = image
     return outs
-
-
-def center_translates(image, size):
-    b, c, h, w = image.shape
-    assert size >= h and size >= w
-    outs = np.zeros((b, c, size, size), dtype=image.dtype)
-    h1 = (size - h) // 2
-    w1 = (size - w) // 2
-    outs[:, :, h1 : h1 + h, w1 : w1 + w] = image
-    return outs
@@ -0,0 +1,203 @@
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import utils
+from logger import EnvStepLogger
+
+
+def _env_worker(conn, env_fn, seed, obses, index):
+    torch.set_num_threads(1)
+    env = env_fn(seed)
+    obs_buf = obses[index].numpy()
+    conn.send(None)
+    while True:
+        try:
+            cmd, data = conn.recv()
+        except EOFError:
+            # the pool's process went away without closing it
+            break
+        if cmd == "reset":
+            obs_buf[...] = env.reset()
+            conn.send(None)
+        elif cmd == "step":
+            obs, reward, done, _ = env.step(data)
+            obs_buf[...] = obs
+            conn.send((reward, done))
+        elif cmd == "render":
+            conn.send(env.render(**data))
+        elif cmd == "close":
+            conn.close()
+            break
+
+
+class EnvPool(object):
+    """Envs stepped in worker processes, observations in shared memory.
+
+    reset and step send one command per env before waiting for any answer,
+    so all envs of a call run in parallel. The latest observation of env i
+    is obses[i]. The constructor returns once every env is built.
+    """
+
+    def __init__(self, env_fn, observation_space, seeds, ctx=None):
+        ctx = ctx or mp.get_context("spawn")
+        dtype = torch.from_numpy(np.empty(0, dtype=observation_space.dtype)).dtype
+        shape = (len(seeds), *observation_space.shape)
+        self._obses = torch.zeros(shape, dtype=dtype).share_memory_()
+        self.obses = self._obses.numpy()
+        self.conns, self.workers = [], []
+        for index, seed in enumerate(seeds):
+            conn, worker_conn = ctx.Pipe()
+            worker = ctx.Process(
+                target=_env_worker,
+                args=(worker_conn, env_fn, seed, self._obses, index),
+                daemon=True,
+            )
+            worker.start()
+            # only the worker holds this end, recv fails if the worker dies
+            worker_conn.close()
+            self.conns.append(conn)
+            self.workers.append(worker)
+        for conn, worker in zip(self.conns, self.workers):
+            try:
+                conn.recv()
+            except EOFError:
+                self.close()
+                raise RuntimeError(
+                    "env worker exited with code %s" % worker.exitcode
+                ) from None
+
+    def __len__(self):
+        return len(self.conns)
+
+    def reset(self, ids):
+        for i in ids:
+            self.conns[i].send(("reset", None))
+        for i in ids:
+            self.conns[i].recv()
+
+    def step(self, ids, actions):
+        """Returns the (reward, done) of every env in ids."""
+        for i, action in zip(ids, actions):
+            self.conns[i].send(("step", action))
+        return [self.conns[i].recv() for i in ids]
+
+    def render(self, i, **kwargs):
+        self.conns[i].send(("render", kwargs))
+        return self.conns[i].recv()
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(("close", None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for worker in self.workers:
+            worker.join()
+
+
+def train_vectorized(
+    args,
+    env_fn,
+    env,
+    agent,
+    replay_buffer,
+    sampler,
+    L,
+    evaluate,
+    poll_evals=None,
+    timer=utils.NULL_TIMER,
+    prof=None,
+):
+    """Trains on args.num_envs envs stepped together in worker processes.
+
+    Every iteration takes one batched actor forward for all envs, steps them
+    in parallel and adds their transitions with one replay_buffer.add_batch.
+    They are always in env order, which lets a FrameReplayBuffer with
+    streams=num_envs keep deduplicating frames. The learner then catches up to args.update_to_data_ratio updates
+    per env step collected after init_steps. env only provides the action
+    space and episode length.
+
+    Metrics are logged at env steps, agent.update counts its own updates.
+    evaluate(step, episode) runs at the first step past every eval_freq env
+    steps and at the end, poll_evals once per iteration. prof steps once per
+    iteration. Returns the number of collected
+    env steps, num_train_steps rounded up to a multiple of num_envs.
+    """
+    num_envs = args.num_envs
+    ids = list(range(num_envs))
+    pool = EnvPool(env_fn, env.observation_space, [args.seed + 1 + i for i in ids])
+    update_logger = EnvStepLogger(L)
+    step, update_step, episode = 0, 0, 0
+    next_eval, next_log = 0, args.log_interval
+    episode_rewards = np.zeros(num_envs)
+    episode_steps = np.zeros(num_envs, dtype=np.int64)
+    # the obs each env acted on, pool.obses is overwritten by the next step
+    obses = np.empty_like(pool.obses)
+    start_time = time.time()
+    try:
+        pool.reset(ids)
+        while step < args.num_train_steps:
+            if step >= next_eval:
+                evaluate(step, episode)
+                while next_eval <= step:
+                    next_eval += args.eval_freq
+            if poll_evals is not None:
+                poll_evals()
+
+            with timer.span("act"):
+                if step < args.init_steps:
+                    actions = np.stack([env.action_space.sample() for _ in ids])
+                else:
+                    with utils.eval_mode(agent):
+                        actions = agent.sample_actions(pool.obses)
+
+            np.copyto(obses, pool.obses)
+            with timer.span("env_step"):
+                rewards, dones = zip(*pool.step(ids, actions))
+            rewards = np.asarray(rewards, dtype=np.float64)
+            dones = np.asarray(dones, dtype=bool)
+            episode_steps += 1
+            # allow infinit bootstrap
+            done_bools = np.where(episode_steps == env._max_episode_steps, 0.0, dones)
+            with timer.span("replay_add"):
+                replay_buffer.add_batch(obses, actions, rewards, pool.obses, done_bools)
+            step += num_envs
+            episode_rewards += rewards
+
+            finished = np.flatnonzero(dones)
+            for i in finished:
+                episode += 1
+                L.log("train/episode_reward", episode_rewards[i], step)
+            if len(finished) > 0:
+                pool.reset(finished)
+                episode_rewards[finished] = 0
+                episode_steps[finished] = 0
+
+            if step >= args.init_steps:
+                update_logger.step = step
+                num_updates = args.update_to_data_ratio * (step - args.init_steps)
+                with timer.span("update"):
+                    while update_step < num_updates:
+                        agent.update(sampler, update_logger, update_step)
+                        update_step += 1
+            if prof is not None:
+                prof.step()
+
+            if step >= next_log:
+                L.log("train/episode", episode, step)
+                L.log("train/duration", time.time() - start_time, step)
+                if sampler is not replay_buffer:
+                    for key, value in sampler.stats().items():
+                        L.log("train/prefetch_" + key, value, step)
+                timer.log(L, step)
+                L.dump(step)
+                start_time = time.time()
+                next_log += args.log_interval
+
+        evaluate(step, episode)
+        return step
+    finally:
+        pool.close()